@@ -4,12 +4,44 @@ from __future__ import unicode_literals
 import os
 import re
 import sys
+import csv
+import json
+import time
+import shutil
+import atexit
+import signal
+import cProfile
+import threading
+import glob
+import heapq
+import hashlib
+import calendar
+import socket
+import sqlite3
+import zipfile
+import subprocess
+import asyncio
+import tarfile
+import argparse
 import requests
-from subprocess import call
+import urllib3
+from subprocess import DEVNULL, PIPE
 from string import punctuation
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict, namedtuple
+from similarity import update_similarity
+from envs import EnvManager, print_env_stats
+from zip_stream import iter_zip_stream
+from batch_tests import (PYTEST_COUNT_PAT, TEST_TIMEOUT, find_suite,
+                         read_names_config, run_suite, submission_names)
 
 # strings of student id's or blank for all
 MY_STUDENT_IDS = []
+# section ids or names, 'mine' for the sections you teach, or blank for all
+SECTIONS = [name.strip() for name in
+            os.environ.get('CANVAS_SECTIONS', '').split(',') if name.strip()]
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 DEFAULT_ROOT_NAME = 'grading'
@@ -24,11 +56,368 @@ API_ROOT = 'https://canvas.instructure.com/api/v1'
 DEFAULT_PARAMS = {'access_token': TOKEN, 'per_page': 999999}
 BAD_CHARS_PAT = re.compile(r'[' + re.escape(punctuation) + r']+')
 GITHUB_REPO_PAT = re.compile(r'https://github.com/.+/.+')
+GITHUB_API_ROOT = os.environ.get('GITHUB_API_ROOT', 'https://api.github.com')
+GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
+GITHUB_URL = 'https://github.com/'
+GIT_PROXY_URL = os.environ.get('GIT_PROXY_URL')
+# Git fails instead of prompting on the terminal for credentials, as it
+# would for a missing or private repo.
+GIT_ENV = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+PULL_URL_PAT = re.compile(r'([^/]+)/([^/]+?)(?:\.git)?/pull/(\d+)')
 DEFAULT_DIR_ORDER = 'as'
+NO_MODULE = {'id': None, 'name': 'no module', 'position': None}
 DIR_ORDERS = 'mas', 'as', 'sa', 'msa'
 
-FILEXISTS_ERR_NUM = 17
-FILEDOESNOTEXIST_ERR_NUM = 2
+FETCH_MODES = 'clone', 'tarball'
+DEFAULT_FETCH_MODE = 'clone'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Seconds a download may wait to connect or for its next bytes.
+DOWNLOAD_TIMEOUT = 60
+# Seconds one git command may run before it is killed.
+GIT_STEP_TIMEOUT = 600
+# Uploaded files are only fetched when set, as by --uploads.
+FETCH_UPLOADS = False
+ZIP_POLL_INTERVAL = 10
+ZIP_POLL_ATTEMPTS = 30
+# Canvas names members <name>[_LATE]_<user id>_<attachment id>_<file name>.
+ZIP_MEMBER_PAT = re.compile(r'^[^_/]+_(?:late_)?(\d+)_\d+_(.+)$', re.I)
+DEFAULT_CONCURRENCY = 8
+JOURNAL_NAME = '.journal.jsonl'
+MANIFEST_NAME = '.manifest.json'
+REPORT_NAME = '.run-report.json'
+ARCHIVE_NAME = '.archive'
+DISK_BUDGET_GB = os.environ.get('GRADING_DISK_BUDGET')
+JOB_STATES = 'planned', 'cloning', 'cloned', 'failed'
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+QUEUE_POLL_INTERVAL = 5
+# Shared test environments, set by --shared-envs; None runs tests here.
+ENVS = None
+GRADE_BATCH_SIZE = 100
+GRADE_POLL_INTERVAL = 2
+GRADE_CSV_FIELDS = ('assignment_id', 'student_id', 'grade', 'comment')
+CACHE_DIR = os.path.join(HERE, '.canvas-cache')
+# Set to False to answer from cached responses without asking Canvas.
+REVALIDATE = True
+GIT_CACHE_DIR = os.path.join(HERE, '.git-cache')
+CANVAS_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+WARM_WINDOW_HOURS = 48
+WARM_BANDWIDTH = 1024 * 1024
+WARM_NICENESS = 19
+MIRROR_STATS_NAME = 'grading-stats.json'
+FETCH_HISTORY = 20
+MAINTENANCE_FETCHES = 10
+MAINTENANCE_LOOSE_OBJECTS = 1000
+MAINTENANCE_PACKS = 10
+MAINTENANCE_INTERVAL_MINUTES = 60
+STORE_NAME = '.submissions.db'
+EXPORT_REQUIRED = ('id', 'assignment_id', 'user_id')
+# Fields read elsewhere without .get(); blank when an export lacks them.
+EXPORT_DEFAULTS = ('attempt', 'submitted_at', 'graded_at', 'workflow_state',
+                   'submission_type', 'url', 'grade', 'score',
+                   'grade_matches_current_submission')
+# A stored submission is rewritten when any of these change.
+VERSION_FIELDS = ('attempt', 'submitted_at', 'workflow_state', 'grade',
+                  'score', 'grade_matches_current_submission')
+EXPORT_TYPES = {
+    'id': int,
+    'assignment_id': int,
+    'user_id': int,
+    'attempt': int,
+    'score': float,
+    'grade_matches_current_submission': lambda value: value.lower() == 'true',
+    'assignment.id': int,
+    'user.id': int,
+}
+WATCH_MIN_INTERVAL = 15
+# Kept under a minute, so a new submission is seen within one.
+WATCH_MAX_INTERVAL = 45
+WATCH_BACKOFF = 1.5
+CACHE_MAX_AGE = 24 * 3600
+ROSTER_MAX_AGE = 6 * 3600
+PIPELINE_QUEUE_SIZE = 64
+PLAN_CONCURRENCY = (4, 8, 16, 32)
+METRICS_INTERVAL = 15
+JOB_SECONDS_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600)
+METRIC_DEFINITIONS = {
+    'canvas_api_requests_total': ('counter', 'Canvas API requests by status.'),
+    'canvas_api_bytes_total': ('counter', 'Canvas API response body bytes.'),
+    'canvas_api_cache_hits_total': (
+        'counter', 'Canvas responses answered 304 from the response cache.'),
+    'canvas_api_cache_hit_ratio': (
+        'gauge', 'Share of Canvas requests answered from the cache.'),
+    'canvas_api_rate_limit_remaining': (
+        'gauge', 'Canvas X-Rate-Limit-Remaining from the last response.'),
+    'grading_git_commands_total': (
+        'counter', 'git commands run by phase and result.'),
+    'grading_jobs_total': ('counter', 'Finished jobs by fetch mode and status.'),
+    'grading_job_bytes_total': ('counter', 'Bytes received by jobs.'),
+    'grading_job_seconds': ('histogram', 'Job duration in seconds.'),
+    'grading_job_failures_total': ('counter', 'Failed jobs by cause.'),
+    'grading_queue_depth': ('gauge', 'Jobs waiting in the scheduler.'),
+    'grading_pipeline_queue_depth': (
+        'gauge', 'Items waiting between pipeline stages.'),
+    'canvas_grade_entries_total': (
+        'counter', 'Grade entries sent to update_grades by outcome.'),
+}
+FAILURE_CAUSES = (
+    ('bad_url', re.compile(r'repository .* (not found|does not exist)|'
+                           r'does not appear to be a git repository|'
+                           r'not a valid repository name|'
+                           r'HTTP 404|404 Client Error', re.I)),
+    ('missing_ref', re.compile(r"couldn't find remote ref|invalid refspec|"
+                               r'pathspec .* did not match', re.I)),
+    ('auth', re.compile(r'authentication failed|could not read username|'
+                        r'permission denied|HTTP 40[13]|40[13] Client Error',
+                        re.I)),
+    ('timeout', re.compile(r'timed? ?out', re.I)),
+    ('network', re.compile(r'could not resolve host|connection (refused|'
+                           r'reset)|unable to access|early EOF', re.I)),
+)
+PROGRESS_INTERVAL = 0.5
+STDERR_TAIL_LEN = 2000
+GIT_PROGRESS_PAT = re.compile(
+    r'Receiving objects:.*?, ([\d.]+) ([KMG]?i?B)')
+BYTE_UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+
+class Tracer(object):
+    """Collect timed spans as Chrome trace events.
+
+    Write the result with write() and open it in chrome://tracing or
+    https://ui.perfetto.dev.
+    """
+
+    def __init__(self):
+        """Start the trace clock."""
+        self.events = []
+        self.lanes = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def lane(self, key):
+        """Return a stable numeric thread id for a job or thread key."""
+        with self.lock:
+            return self.lanes.setdefault(key, len(self.lanes) + 1)
+
+    @contextmanager
+    def span(self, name, cat, lane=None, **args):
+        """Record the time spent in the with block as one event.
+
+        Callable args are called for their values, so call sites can put
+        off work that is only needed while profiling.
+        """
+        args = dict((key, value() if callable(value) else value)
+                    for key, value in args.items())
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': self.lane(lane or threading.current_thread().name),
+                'args': args,
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def write(self, path):
+        """Write the trace events as JSON, naming each lane."""
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                  'tid': tid, 'args': {'name': str(key)}}
+                 for key, tid in self.lanes.items()]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': names + self.events}, f)
+
+
+TRACER = None
+NO_SPAN = nullcontext()
+
+
+def span(name, cat='stage', lane=None, **args):
+    """Return a context manager timing a stage when profiling is on."""
+    if TRACER is None:
+        return NO_SPAN
+    return TRACER.span(name, cat, lane, **args)
+
+
+def start_profiling(trace_path, cprofile_path=None):
+    """Record spans, and optionally cProfile stats, until the run exits."""
+    global TRACER
+    TRACER = Tracer()
+    atexit.register(TRACER.write, trace_path)
+    if cprofile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def dump():
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+        atexit.register(dump)
+
+
+class Metrics(object):
+    """Counters, gauges and histograms in Prometheus text format."""
+
+    def __init__(self, definitions=METRIC_DEFINITIONS):
+        """Initialize with a dict of name to (kind, help text)."""
+        self.definitions = definitions
+        self.values = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        """Return the storage key of a metric and its labels."""
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to a counter."""
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+        with self.lock:
+            self.values[self.key(name, labels)] = value
+
+    def get(self, name, **labels):
+        """Return the current value of a counter or gauge."""
+        return self.values.get(self.key(name, labels), 0)
+
+    def total(self, name):
+        """Return the sum of a metric over all of its labels."""
+        with self.lock:
+            return sum(value for (metric, labels), value
+                       in self.values.items() if metric == name)
+
+    def observe(self, name, value, buckets=JOB_SECONDS_BUCKETS, **labels):
+        """Record one observation in a histogram."""
+        key = self.key(name, labels)
+        with self.lock:
+            counts, total, num = self.histograms.get(
+                key, ([0] * len(buckets), 0, 0))
+            counts = [count + (value <= bound)
+                      for count, bound in zip(counts, buckets)]
+            self.histograms[key] = counts, total + value, num + 1
+
+    def render(self, buckets=JOB_SECONDS_BUCKETS):
+        """Return all metrics in Prometheus text exposition format."""
+        def fmt(name, labels, value):
+            label_text = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+            return '{}{} {}'.format(
+                name, '{' + label_text + '}' if labels else '', value)
+
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted(self.histograms.items())
+        lines = []
+        for name, (kind, help_text) in sorted(self.definitions.items()):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (metric, labels), value in values:
+                if metric == name:
+                    lines.append(fmt(name, labels, value))
+            for (metric, labels), (counts, total, num) in histograms:
+                if metric != name:
+                    continue
+                for bound, count in zip(buckets, counts):
+                    lines.append(fmt(name + '_bucket',
+                                     labels + (('le', bound), ), count))
+                lines.append(fmt(name + '_bucket',
+                                 labels + (('le', '+Inf'), ), num))
+                lines.append(fmt(name + '_sum', labels, total))
+                lines.append(fmt(name + '_count', labels, num))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def write_metrics(path):
+    """Atomically write the current metrics to a file."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(METRICS.render())
+    os.replace(tmp, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the current metrics at /metrics."""
+
+    def log_message(self, *args):
+        """Keep scrapes out of the terminal."""
+
+    def do_GET(self):
+        """Send the metrics text."""
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics(port=None, path=None):
+    """Serve metrics on port and/or keep writing them to path."""
+    if port:
+        server = ThreadingHTTPServer(('', port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    if path:
+        def writer():
+            while True:
+                write_metrics(path)
+                time.sleep(METRICS_INTERVAL)
+        thread = threading.Thread(target=writer)
+        thread.daemon = True
+        thread.start()
+        atexit.register(write_metrics, path)
+
+
+def record_api_response(response, cached=False):
+    """Count a Canvas response in the API metrics."""
+    METRICS.inc('canvas_api_requests_total', status=response.status_code)
+    if cached:
+        METRICS.inc('canvas_api_cache_hits_total')
+    else:
+        METRICS.inc('canvas_api_bytes_total', len(response.content))
+    remaining = response.headers.get('X-Rate-Limit-Remaining')
+    if remaining is not None:
+        METRICS.set('canvas_api_rate_limit_remaining', float(remaining))
+    METRICS.set('canvas_api_cache_hit_ratio', round(
+        METRICS.get('canvas_api_cache_hits_total') /
+        float(METRICS.total('canvas_api_requests_total')), 4))
+
+
+def failure_cause(stderr):
+    """Return a short cause name for a failed job's error output."""
+    for cause, pattern in FAILURE_CAUSES:
+        if pattern.search(stderr or ''):
+            return cause
+    return 'other'
+
+
+def record_job(job):
+    """Count a finished job in the job metrics."""
+    status = 'failed' if job.failed else 'ok'
+    METRICS.inc('grading_jobs_total', mode=job.mode, status=status)
+    METRICS.inc('grading_job_bytes_total', job.bytes)
+    METRICS.observe('grading_job_seconds', job.elapsed, mode=job.mode)
+    if job.failed:
+        METRICS.inc('grading_job_failures_total',
+                    cause=failure_cause(job.stderr))
 
 
 def students_request_string(students=MY_STUDENT_IDS):
@@ -38,11 +427,89 @@ def students_request_string(students=MY_STUDENT_IDS):
     return students
 
 
+def cache_path(url, params):
+    """Return the response cache file for a request, ignoring the token."""
+    key = json.dumps(
+        [url, sorted((k, v) for k, v in params.items() if k != 'access_token')],
+        sort_keys=True)
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+    return os.path.join(CACHE_DIR, name)
+
+
+class CachedResponse(object):
+    """Decoded body and pagination links of a cached or fresh response."""
+
+    def __init__(self, entry, status_code=304):
+        """Initialize with a response cache entry."""
+        self.entry = entry
+        self.status_code = status_code
+        self.url = entry['url']
+        self.links = entry['links']
+
+    def json(self):
+        """Return the cached JSON body."""
+        return self.entry['body']
+
+
+def read_cache(path):
+    """Return the response cache entry at path, or None."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_cache(path, entry):
+    """Atomically store a response cache entry at path."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp, path)
+
+
+def cached_get(url, params):
+    """Return response of a conditional GET, served from cache on 304."""
+    path = cache_path(url, params)
+    entry = read_cache(path)
+    if entry is not None and not REVALIDATE:
+        return CachedResponse(entry)
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    with span('page fetch', 'api', url=url):
+        response = requests.get(url, params=params, headers=headers)
+    record_api_response(response, cached=response.status_code == 304)
+    if response.status_code == 304 and entry is not None:
+        return CachedResponse(entry)
+    if response.ok:
+        try:
+            with span('decode', 'api', bytes=len(response.content)):
+                body = response.json()
+        except ValueError:
+            return response
+        entry = {
+            'url': response.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'links': response.links,
+            'body': body,
+            'time': time.time(),
+        }
+        write_cache(path, entry)
+        return CachedResponse(entry, response.status_code)
+    return response
+
+
 def api_request(url, **kwargs):
     """Return json information from specified API query."""
     params = DEFAULT_PARAMS.copy()
     params.update(kwargs)
-    response = requests.get(url, params=params)
+    response = cached_get(url, params)
 
     try:
         # Currently assumes that result is a list of json objects.
@@ -76,10 +543,10 @@ def joined_api_request(*args, **kwargs):
         yield item
 
 
-def get_course_modules(course_id):
+def get_course_modules(course_id, **kwargs):
     """Return list of module dicts of the course specified by ID."""
     args = (API_ROOT, 'courses', course_id, 'modules')
-    for module in joined_api_request(*args):
+    for module in joined_api_request(*args, **kwargs):
         yield module
 
 
@@ -97,16 +564,47 @@ def get_course_assignments(course_id):
         yield assignment
 
 
-def get_course_submissions(course_id):
-    """Return list of submission dicts of the course specified by ID."""
-    args = (API_ROOT, 'courses', course_id, 'students', 'submissions')
+def get_course_sections(course_id, **kwargs):
+    """Return list of section dicts of the course specified by ID."""
+    args = (API_ROOT, 'courses', course_id, 'sections')
+    for section in joined_api_request(*args, **kwargs):
+        yield section
+
+
+def get_my_section_ids(course_id):
+    """Return ids of the course sections the token's user teaches."""
+    args = (API_ROOT, 'courses', course_id, 'enrollments')
+    enrollments = joined_api_request(*args, user_id='self')
+    return sorted(set(
+        str(enrollment['course_section_id']) for enrollment in enrollments
+        if enrollment.get('type') in ('TaEnrollment', 'TeacherEnrollment')))
+
+
+def get_course_submissions(course_id, **params):
+    """Return list of submission dicts of the course specified by ID.
+
+    Extra params such as submitted_since are passed on to the API. When
+    SECTIONS is set, only those sections' submissions are requested.
+    """
     kwargs = {
         'student_ids[]': students_request_string(),
         'include[]': ['assignment', 'user']
     }
+    kwargs.update(params)
+    if not SECTIONS:
+        args = (API_ROOT, 'courses', course_id, 'students', 'submissions')
+        for submission in joined_api_request(*args, **kwargs):
+            yield submission
+        return
 
-    for submission in joined_api_request(*args, **kwargs):
-        yield submission
+    # A student in several sections is listed once per section.
+    seen = set()
+    for section_id in resolve_sections(course_id, SECTIONS):
+        args = (API_ROOT, 'sections', section_id, 'students', 'submissions')
+        for submission in joined_api_request(*args, **kwargs):
+            if submission['id'] not in seen:
+                seen.add(submission['id'])
+                yield submission
 
 
 def get_assignment_submissions(asgn):
@@ -118,6 +616,134 @@ def get_assignment_submissions(asgn):
         yield submission
 
 
+def module_index_path(course_id):
+    """Return the cache file of a course's assignment to module index."""
+    return os.path.join(CACHE_DIR, 'modules-{}.json'.format(course_id))
+
+
+def modules_fingerprint(modules):
+    """Return a hash that changes whenever modules or their items change."""
+    summary = [
+        [module.get(key) for key in ('id', 'name', 'position',
+                                     'items_count', 'published')]
+        for module in modules
+    ]
+    return hashlib.sha1(json.dumps(summary).encode('utf-8')).hexdigest()
+
+
+def module_items(module):
+    """Return the items of a module, fetching them if not included."""
+    if module.get('items') is not None:
+        return module['items']
+    return list(api_request(module['items_url']))
+
+
+def build_module_index(modules):
+    """Return dict of assignment id string to its module's summary dict."""
+    index = {}
+    for module in modules:
+        summary = {key: module.get(key) for key in ('id', 'name', 'position')}
+        for item in module_items(module):
+            if item.get('type') == 'Assignment':
+                index[str(item['content_id'])] = summary
+    return index
+
+
+def load_module_index(course_id):
+    """Return the assignment to module index, rebuilt only when stale.
+
+    The module list is cheap to fetch, so it is compared against the
+    fingerprint stored with the cached index; items are only fetched when
+    the modules changed.
+    """
+    modules = list(get_course_modules(course_id))
+    fingerprint = modules_fingerprint(modules)
+    path = module_index_path(course_id)
+    cached = read_cache(path)
+    if cached is not None and cached['fingerprint'] == fingerprint:
+        return cached['index']
+    # Canvas leaves out items of big modules; module_items fetches those.
+    with_items = get_course_modules(course_id, **{'include[]': 'items'})
+    index = build_module_index(with_items)
+    write_cache(path, {'fingerprint': fingerprint, 'index': index})
+    return index
+
+
+def section_roster_path(course_id):
+    """Return the cache file of a course's section roster."""
+    return os.path.join(CACHE_DIR, 'sections-{}.json'.format(course_id))
+
+
+def sections_fingerprint(sections):
+    """Return a hash that changes whenever sections or their sizes change."""
+    summary = [
+        [section.get(key) for key in ('id', 'name', 'total_students')]
+        for section in sections
+    ]
+    return hashlib.sha1(json.dumps(summary).encode('utf-8')).hexdigest()
+
+
+def print_roster_changes(old, new, stream=sys.stdout):
+    """Print students added to and dropped from each section."""
+    for section_id, section in sorted(new.items()):
+        before = set(old.get(section_id, {}).get('students', ()))
+        after = set(section['students'])
+        if before != after:
+            stream.write('section {}: {} added, {} dropped\n'.format(
+                section['name'], len(after - before), len(before - after)))
+
+
+def load_section_roster(course_id):
+    """Return dict of section id string to its name and student ids.
+
+    Like the module index, the roster is only fetched again when the
+    section list, which carries each section's size, has changed. Swaps
+    that keep a section's size are picked up once it is ROSTER_MAX_AGE
+    old.
+    """
+    sections = list(get_course_sections(
+        course_id, **{'include[]': 'total_students'}))
+    fingerprint = sections_fingerprint(sections)
+    path = section_roster_path(course_id)
+    cached = read_cache(path)
+    if cached is not None and cached['fingerprint'] == fingerprint and \
+            time.time() - cached['time'] < ROSTER_MAX_AGE:
+        return cached['roster']
+    roster = {}
+    for section in get_course_sections(course_id, **{'include[]': 'students'}):
+        roster[str(section['id'])] = {
+            'name': section['name'],
+            'students': sorted(str(student['id'])
+                               for student in section.get('students') or ()),
+        }
+    if cached is not None:
+        print_roster_changes(cached['roster'], roster)
+    write_cache(path, {'fingerprint': fingerprint, 'roster': roster,
+                       'time': time.time()})
+    return roster
+
+
+def resolve_sections(course_id, names):
+    """Return section id strings for a list of section ids or names.
+
+    'mine' stands for every section the token's user teaches.
+    """
+    roster = load_section_roster(course_id)
+    by_name = {section['name'].lower(): section_id
+               for section_id, section in roster.items()}
+    section_ids = []
+    for name in names:
+        if name == 'mine':
+            section_ids.extend(get_my_section_ids(course_id))
+        elif str(name) in roster:
+            section_ids.append(str(name))
+        elif name.lower() in by_name:
+            section_ids.append(by_name[name.lower()])
+        else:
+            raise ValueError('Unknown section: {}'.format(name))
+    return sorted(set(section_ids))
+
+
 def make_dirname(name):
     """Return new string with no punctuation and spaces replaced with '-'."""
     name = re.sub(BAD_CHARS_PAT, '', name)
@@ -125,31 +751,102 @@ def make_dirname(name):
     return name.lower()
 
 
-def make_dir_path(root, assignment, student, dir_order):
-    """Create a directory path from the given components."""
+def item_dirname(item):
+    """Return the directory name slug of an assignment or student dict."""
+    return make_dirname(item.get('name', item.get('title', '')))
+
+
+def dir_path_items(assignment, student, dir_order, modules=None):
+    """Return the items named by each level of the directory order.
+
+    modules is an index from load_module_index, needed for orders with 'm'.
+    """
     charmap = {
         'a': assignment,
         's': student,
     }
-    items = map(lambda char: charmap[char], dir_order)
-    names = map(lambda item: item.get('name', item.get('title', '')), items)
-    dirnames = map(make_dirname, names)
-    return os.path.join(root, *dirnames)
+    if 'm' in dir_order:
+        charmap['m'] = (modules or {}).get(str(assignment['id']), NO_MODULE)
+    return [charmap[char] for char in dir_order]
 
 
-def make_directory(path):
-    """Create a new directory with the given path."""
-    try:
+def make_dir_path(root, assignment, student, dir_order, modules=None):
+    """Create a directory path from the given components."""
+    items = dir_path_items(assignment, student, dir_order, modules)
+    return os.path.join(root, *map(item_dirname, items))
+
+
+LayoutPlan = namedtuple('LayoutPlan', ('root', 'paths', 'collisions'))
+
+
+def plan_layout(submissions, root, dir_order, modules=None):
+    """Return a LayoutPlan with a target path for each submission.
+
+    When different assignments or students share a slug, each of them gets
+    its Canvas id appended so they never share a directory.
+    """
+    levels = [
+        dir_path_items(sub['assignment'], sub['user'], dir_order, modules)
+        for sub in submissions
+    ]
+    owners = defaultdict(set)
+    for items in levels:
+        for char, item in zip(dir_order, items):
+            owners[char, item_dirname(item)].add(item.get('id'))
+    collisions = {
+        key: sorted(ids) for key, ids in owners.items() if len(ids) > 1
+    }
+
+    def dirname(char, item):
+        slug = item_dirname(item)
+        if (char, slug) in collisions:
+            return '-'.join((slug, str(item.get('id'))))
+        return slug
+
+    paths = [
+        (sub, os.path.join(root, *map(dirname, dir_order, items)))
+        for sub, items in zip(submissions, levels)
+    ]
+    return LayoutPlan(root, paths, collisions)
+
+
+def make_directories(root, paths):
+    """Create root and every path below it in one pass.
+
+    Each existing directory is listed at most once, and children of newly
+    created directories are made without checking. Return the list of
+    directories created.
+    """
+    os.makedirs(root, exist_ok=True)
+    wanted = set()
+    for path in paths:
+        while path != root and path not in wanted:
+            wanted.add(path)
+            path = os.path.dirname(path)
+
+    created = []
+    fresh = set()
+    listings = {}
+    for path in sorted(wanted, key=lambda path: path.count(os.sep)):
+        parent, child = os.path.split(path)
+        if parent not in fresh:
+            if parent not in listings:
+                listings[parent] = set(os.listdir(parent))
+            if child in listings[parent]:
+                continue
         os.mkdir(path)
-    except OSError as e:
-        # Path already exists; ignore.
-        if e.errno == FILEXISTS_ERR_NUM:
-            pass
-        elif e.errno == FILEDOESNOTEXIST_ERR_NUM:
-            # Parent path does not exist; try to make it.
-            parent, child = os.path.split(path)
-            make_directory(parent)
-            make_directory(path)
+        fresh.add(path)
+        created.append(path)
+    return created
+
+
+def print_plan(plan, created, stream=sys.stdout):
+    """Print a summary of the planned directory layout."""
+    stream.write('{} submission directories under {}, {} new\n'.format(
+        len(plan.paths), plan.root, len(created)))
+    for (char, slug), ids in sorted(plan.collisions.items()):
+        stream.write('  name collision: {} -> {}\n'.format(
+            slug, ', '.join('{}-{}'.format(slug, i) for i in ids)))
 
 
 def is_git_repo(submission):
@@ -167,6 +864,18 @@ def is_git_repo(submission):
     ))
 
 
+def is_upload(submission):
+    """Return boolean of whether the submission is uploaded files."""
+    return bool(submission.get('submission_type') == 'online_upload' and
+                submission.get('attachments'))
+
+
+def is_fetchable(submission):
+    """Return whether a submission is a repo, or uploads when wanted."""
+    return is_git_repo(submission) or (FETCH_UPLOADS and
+                                       is_upload(submission))
+
+
 def needs_grading(submission):
     """Return boolean of whether the given submission needs to be graded."""
     return any((
@@ -176,75 +885,2388 @@ def needs_grading(submission):
     ))
 
 
-def get_git_repo(submission, student, path):
-    """Clone student repo, fetch submitted pull request into grading branch."""
-    repo_url = submission['url']
+def parse_repo_url(url):
+    """Return the clonable repo url and refspec for a submission url."""
     try:
-        repo_url, pull_info = repo_url.split('/pull/')
+        repo_url, pull_info = url.split('/pull/')
         pull_num = pull_info.split('/')[0]
         refspec = '/'.join(('pull', pull_num, 'head'))
     except ValueError:
         # may be able to use /tree/ or /blob/ as refspecs instead of master
+        repo_url = url
         for pathspec in ('/tree/', '/blob/'):
             repo_url = repo_url.split(pathspec)[0]
         refspec = 'master'
 
     repo_url = repo_url + '.git' * (not repo_url.endswith('.git'))
+    return repo_url, refspec
+
+
+def mirror_path(repo_url):
+    """Return the local mirror directory for a clonable repo url."""
+    owner, repo = repo_url.rstrip('/').split('/')[-2:]
+    return os.path.join(GIT_CACHE_DIR, owner, repo)
+
+
+def git_base_args():
+    """Return the git command prefix, routing GitHub through any proxy."""
+    if not GIT_PROXY_URL:
+        return ['git']
+    rewrite = 'url.{}/.insteadOf={}'.format(GIT_PROXY_URL.rstrip('/'),
+                                            GITHUB_URL)
+    return ['git', '-c', rewrite]
+
+
+def git_commands(submission, student, path):
+    """Return list of (phase, args) git steps to grade the submission.
+
+    When a warmed mirror of the repo exists, the clone is made from it and
+    only objects newer than the mirror are fetched from the real remote.
+    A path that already holds a checkout is refreshed in place instead:
+    the submitted ref is fetched and the grading branch reset to it.
+    """
+    repo_url, refspec = parse_repo_url(submission['url'])
     local_branchname = '-'.join(('grading', make_dirname(student['name'])))
+    mirror = mirror_path(repo_url)
+    git = git_base_args()
+    if is_checkout(path):
+        return [
+            ('remote', git + ['remote', 'set-url', 'origin', repo_url]),
+            ('fetch', git + ['fetch', '--progress', 'origin', refspec]),
+            ('checkout', git + ['checkout', '-B', local_branchname,
+                                'FETCH_HEAD']),
+        ]
+    if os.path.isdir(mirror):
+        clone = [
+            ('clone', git + ['clone', '--progress', mirror, path]),
+            ('remote', git + ['remote', 'set-url', 'origin', repo_url]),
+        ]
+    else:
+        clone = [('clone', git + ['clone', '--progress', repo_url, path])]
+    return clone + [
+        ('fetch', git + ['fetch', '--progress', 'origin',
+                         ':'.join((refspec, local_branchname))]),
+        ('checkout', git + ['checkout', local_branchname]),
+        ('pull', git + ['pull', '--no-edit', 'origin', refspec]),
+    ]
 
-    print('cloning from {}'.format(repo_url))
-    call(['git', 'clone', repo_url, path], cwd=path)
-    print('fetching from refspec: {}'.format(refspec))
-    call(
-        ['git', 'fetch', 'origin', ':'.join((refspec, local_branchname))],
-        cwd=path
-    )
-    call(['git', 'checkout', local_branchname], cwd=path)
-    print('pulling from refspec: {}'.format(refspec))
-    call(['git', 'pull', '--no-edit', 'origin', refspec], cwd=path)
 
+def github_request(url, **kwargs):
+    """Return a GET response from the GitHub API, authorized if possible."""
+    headers = {'Accept': 'application/vnd.github+json'}
+    if GITHUB_TOKEN:
+        headers['Authorization'] = 'token ' + GITHUB_TOKEN
+    kwargs.setdefault('timeout', DOWNLOAD_TIMEOUT)
+    response = requests.get(url, headers=headers, **kwargs)
+    response.raise_for_status()
+    return response
 
-def print_failures(fail_list):
-    """Print failuers from main script.
 
-    This appears to happen when someone does not submit a valid PR.
+def resolve_pr_head(url):
+    """Return (repo full name, commit sha) of the head of a pull request url.
+
+    Urls without a pull request resolve to the repo's master branch.
     """
-    print('----------' * 5)
-    print('FAILURES:')
-    for fail in fail_list:
-        print(re.split(DEFAULT_ROOT_NAME, fail)[1])
+    match = PULL_URL_PAT.search(url)
+    if match is None:
+        repo_url, refspec = parse_repo_url(url)
+        owner, repo = repo_url[:-len('.git')].split('/')[-2:]
+        return '/'.join((owner, repo)), refspec
 
+    owner, repo, pull_num = match.groups()
+    pull_url = '/'.join((GITHUB_API_ROOT, 'repos', owner, repo, 'pulls',
+                         pull_num))
+    head = github_request(pull_url).json()['head']
+    # The head repo is gone when a fork was deleted after opening the PR.
+    full_name = (head.get('repo') or {}).get('full_name', owner + '/' + repo)
+    return full_name, head['sha']
 
-if __name__ == '__main__':
 
-    fail_list = []
+def read_raw(stream, size):
+    """Read from a raw response stream, raising OSError if it fails."""
     try:
-        dir_order = sys.argv[1]
-    except IndexError:
-        dir_order = DEFAULT_DIR_ORDER
+        return stream.read(size)
+    except urllib3.exceptions.HTTPError as e:
+        # Read timeouts and dropped connections are not OSErrors here.
+        raise OSError(str(e))
 
-    if dir_order not in DIR_ORDERS:
-        print('Invalid directory order acronym.')
-        sys.exit()
 
-    root = os.path.join(HERE, DEFAULT_ROOT_NAME)
-    submissions = get_course_submissions(COURSE_ID)
-    submissions_to_grade = filter(needs_grading, submissions)
-    github_submissions = filter(is_git_repo, submissions_to_grade)
-
-    for sub in github_submissions:
-        asgn = sub['assignment']
-        stu = sub['user']
-        print("\n{}'s submission for {}: {}".format(
-            stu['name'], asgn['name'], sub['url'])
+class ByteCounter(object):
+    """Read-only file wrapper that counts bytes read, also to a GitJob."""
+
+    def __init__(self, stream, job=None):
+        """Initialize with the underlying stream and the job to update."""
+        self.stream = stream
+        self.job = job
+        self.bytes = 0
+
+    def read(self, size=DOWNLOAD_CHUNK_SIZE):
+        """Read from the stream and count the bytes."""
+        data = read_raw(self.stream, size)
+        self.bytes += len(data)
+        if self.job is not None:
+            self.job.bytes += len(data)
+        return data
+
+
+def strip_top_dir(member):
+    """Return the tar member renamed without its top level directory."""
+    parts = member.name.split('/', 1)
+    if len(parts) < 2 or not parts[1]:
+        return None
+    member.name = parts[1]
+    return member
+
+
+def get_tarball(job):
+    """Download the tree at the submission head and extract it into path."""
+    job.phase = 'resolve'
+    with span('resolve', 'tarball', lane=job.path, job=lambda: job.key):
+        full_name, sha = resolve_pr_head(job.submission['url'])
+    job.phase = 'download'
+    url = '/'.join((GITHUB_API_ROOT, 'repos', full_name, 'tarball', sha))
+    with span('download', 'tarball', lane=job.path, job=lambda: job.key):
+        response = github_request(url, stream=True)
+        response.raw.decode_content = True
+        with tarfile.open(fileobj=ByteCounter(response.raw, job),
+                          mode='r|*') as tar:
+            for member in tar:
+                member = strip_top_dir(member)
+                if member is not None:
+                    tar.extract(member, job.path, filter='data')
+
+
+def attachment_filename(attachment):
+    """Return a safe local file name for a submission attachment."""
+    name = os.path.basename(attachment.get('filename') or
+                            attachment.get('display_name') or '')
+    return name if name not in ('', '.', '..') else str(attachment['id'])
+
+
+def download_attachment(attachment, path, job):
+    """Stream one attachment into path, resuming a partial download.
+
+    Bytes go to a .part file named after the attachment id, so a
+    different upload with the same name never resumes it. The file is
+    only moved into place once its size matches Canvas's.
+    """
+    dest = os.path.join(path, attachment_filename(attachment))
+    part = '{}.{}.part'.format(dest, attachment['id'])
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Authorization': 'Bearer ' + TOKEN}
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+    with span('download', 'upload', lane=job.path, job=lambda: job.key,
+              offset=offset):
+        response = requests.get(attachment['url'], headers=headers,
+                                stream=True, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code == 416:
+            # The partial file is already as long as the server's copy.
+            response.close()
+            os.remove(part)
+            return download_attachment(attachment, path, job)
+        response.raise_for_status()
+        with open(part, 'ab' if response.status_code == 206 else 'wb') as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                job.bytes += len(chunk)
+    size = os.path.getsize(part)
+    if attachment.get('size') is not None and size != attachment['size']:
+        if size > attachment['size']:
+            os.remove(part)
+        raise OSError('{}: got {} of {} bytes'.format(
+            attachment_filename(attachment), size, attachment['size']))
+    os.replace(part, dest)
+
+
+def get_attachments(job):
+    """Download every attachment of an uploaded-file submission."""
+    job.phase = 'download'
+    for attachment in job.submission['attachments']:
+        download_attachment(attachment, job.path, job)
+
+
+def member_path(directory, name):
+    """Return where a zip member goes below directory, or None if unsafe."""
+    parts = [part for part in name.replace('\\', '/').split('/') if part]
+    if not parts or any(part in ('.', '..') for part in parts):
+        return None
+    return os.path.join(directory, *parts)
+
+
+def open_submissions_zip(assignment):
+    """Return a streaming response for an assignment's submissions zip.
+
+    Canvas builds the archive on the first request and answers with a
+    page until it is ready, so this polls until a zip arrives.
+    """
+    url = assignment['submissions_download_url']
+    headers = {'Authorization': 'Bearer ' + TOKEN}
+    for attempt in range(ZIP_POLL_ATTEMPTS):
+        response = requests.get(url, headers=headers, stream=True,
+                                timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        if 'zip' in response.headers.get('Content-Type', ''):
+            return response
+        response.close()
+        time.sleep(ZIP_POLL_INTERVAL)
+    raise OSError('submissions zip of {} was not ready'.format(
+        assignment['name']))
+
+
+def unpack_submissions_zip(assignment, paths, stream=sys.stdout):
+    """Download an assignment's submissions zip once and unpack it.
+
+    paths maps user id strings to their submission directory; members of
+    other students are skipped. Return dict of bytes received and, per
+    user id that got files, [first start, last finish, bytes written].
+    """
+    extracted = {}
+    skipped = 0
+    with span('submissions zip', 'upload', assignment=assignment['name']):
+        response = open_submissions_zip(assignment)
+        response.raw.decode_content = True
+        counter = ByteCounter(response.raw)
+        for name, chunks in iter_zip_stream(counter):
+            match = ZIP_MEMBER_PAT.match(name.rstrip('/'))
+            user_id = match.group(1) if match else None
+            dest = member_path(paths[user_id], match.group(2)) \
+                if user_id in paths else None
+            if dest is None or name.endswith('/'):
+                skipped += 1
+                continue
+            timing = extracted.setdefault(user_id, [time.time(), None, 0])
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, 'wb') as f:
+                for data in chunks:
+                    f.write(data)
+                    timing[2] += len(data)
+            timing[1] = time.time()
+    stream.write('{}: {} of {} students unpacked, {} members skipped, '
+                 '{}\n'.format(assignment['name'], len(extracted), len(paths),
+                               skipped, format_bytes(counter.bytes)))
+    return {'bytes': counter.bytes, 'users': extracted}
+
+
+def fetch_submission_zips(paths, journal=None, stream=sys.stdout):
+    """Fetch upload submissions one assignment zip at a time.
+
+    paths is a list of (submission, path) pairs of upload submissions.
+    Return (jobs, missing): finished jobs of the unpacked submissions,
+    timed and sized by their own members, for the manifest and run
+    report, and the pairs that were not found in their assignment's zip.
+    """
+    by_assignment = defaultdict(list)
+    for sub, path in paths:
+        by_assignment[sub['assignment_id']].append((sub, path))
+    jobs, missing = [], []
+    for pairs in by_assignment.values():
+        assignment = pairs[0][0]['assignment']
+        users = dict((str(sub['user_id']), path) for sub, path in pairs)
+        try:
+            result = unpack_submissions_zip(assignment, users, stream)
+        except (OSError, zipfile.BadZipFile) as e:
+            stream.write('{}: {}\n'.format(assignment['name'], e))
+            result = {'users': {}}
+        for sub, path in pairs:
+            timing = result['users'].get(str(sub['user_id']))
+            if timing is None:
+                missing.append((sub, path))
+                continue
+            job = GitJob(sub, sub['user'], path)
+            job.started, job.finished, job.bytes = timing
+            job.phase = 'done'
+            record_job(job)
+            jobs.append(job)
+            if journal is not None:
+                journal.record(job.key, 'cloning', path=path)
+                journal.record(job.key, 'cloned',
+                               seconds=round(job.elapsed, 3))
+    return jobs, missing
+
+
+def format_bytes(num):
+    """Return a short human readable string for a number of bytes."""
+    for unit in ('B', 'KiB'):
+        if num < 1024:
+            return '{:.0f}{}'.format(num, unit)
+        num /= 1024.0
+    if num < 1024:
+        return '{:.1f}MiB'.format(num)
+    return '{:.1f}GiB'.format(num / 1024.0)
+
+
+class GitJob(object):
+    """Progress and timing of the git steps for one submission."""
+
+    def __init__(self, submission, student, path, mode=DEFAULT_FETCH_MODE):
+        """Initialize with the submission, its student and target path."""
+        self.submission = submission
+        self.student = student
+        self.path = path
+        self.mode = 'attachments' if is_upload(submission) else mode
+        self.phase = 'queued'
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+        self.failed = False
+        self.stderr = ''
+
+    @property
+    def key(self):
+        """Return the journal key of this job's submission."""
+        return job_key(self.submission)
+
+    @property
+    def name(self):
+        """Return the student name for display."""
+        return self.student['name']
+
+    @property
+    def elapsed(self):
+        """Return seconds spent on this job so far."""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def done(self):
+        """Return whether all of this job's work is over."""
+        return self.finished is not None
+
+
+def parse_git_progress(text):
+    """Return bytes received from the last progress line in text, or None."""
+    matches = GIT_PROGRESS_PAT.findall(text)
+    if not matches:
+        return None
+    amount, unit = matches[-1]
+    return int(float(amount) * BYTE_UNITS.get(unit, 1))
+
+
+async def run_git_step(job, args, timeout=GIT_STEP_TIMEOUT):
+    """Run one git command for job, streaming its progress; return code.
+
+    A command still running after timeout seconds is killed and fails.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args, cwd=job.path, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE,
+        env=GIT_ENV)
+    base_bytes = job.bytes
+    job.stderr = ''
+
+    async def follow():
+        while True:
+            chunk = await proc.stderr.read(4096)
+            if not chunk:
+                break
+            job.stderr = (job.stderr + chunk.decode('utf-8', 'replace')
+                          )[-STDERR_TAIL_LEN:]
+            received = parse_git_progress(job.stderr)
+            if received is not None:
+                job.bytes = base_bytes + received
+        return await proc.wait()
+
+    try:
+        return await asyncio.wait_for(follow(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        job.stderr += '\ngit {} timed out after {}s'.format(job.phase,
+                                                           timeout)
+        return proc.returncode
+
+
+async def run_clone_steps(job):
+    """Run the clone, fetch, checkout and pull steps, stopping on failure."""
+    if os.path.isdir(job.path) and os.listdir(job.path) and \
+            not is_checkout(job.path):
+        # git clone needs an empty directory, as a tarball run leaves none.
+        reset_directory(job.path)
+    for phase, args in git_commands(job.submission, job.student, job.path):
+        job.phase = phase
+        with span(phase, 'git', lane=job.path, job=lambda: job.key):
+            returncode = await run_git_step(job, args)
+        METRICS.inc('grading_git_commands_total', phase=phase,
+                    result='ok' if returncode == 0 else 'failed')
+        if returncode:
+            job.failed = True
+            return
+    job.phase = 'done'
+
+
+async def run_git_job(job, journal=None):
+    """Run the git or download steps for a single job."""
+    job.started = time.time()
+    if journal is not None:
+        journal.record(job.key, 'cloning', path=job.path)
+    try:
+        if job.mode == 'tarball':
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, get_tarball, job)
+            job.phase = 'done'
+        elif job.mode == 'attachments':
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, get_attachments, job)
+            job.phase = 'done'
+        else:
+            await run_clone_steps(job)
+    except (OSError, tarfile.TarError) as e:
+        job.failed = True
+        job.stderr = str(e)
+    finally:
+        job.finished = time.time()
+        record_job(job)
+        if journal is not None:
+            state = 'failed' if job.failed else 'cloned'
+            journal.record(job.key, state, seconds=round(job.elapsed, 3))
+
+
+def read_focus_file(path):
+    """Return list of assignment names or ids, one per non-blank line."""
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class JobScheduler(object):
+    """Priority queue handing out the first-needed GitJob next.
+
+    Jobs for assignments in the focus list come first, in list order,
+    then by assignment due date and submission time. When a focus file
+    is given it is re-read whenever it changes, so priorities can be
+    adjusted while a run is in progress.
+    """
+
+    def __init__(self, jobs=(), focus=(), focus_file=None):
+        """Initialize with jobs and an optional assignment focus list."""
+        self.focus = list(focus)
+        self.focus_file = focus_file
+        self.focus_mtime = None
+        self.heap = []
+        self.count = 0
+        self.lock = threading.Lock()
+        self.refresh()
+        for job in jobs:
+            self.push(job)
+
+    def __len__(self):
+        """Return number of jobs waiting."""
+        return len(self.heap)
+
+    def priority(self, job):
+        """Return the sort key of a job; smaller runs sooner."""
+        asgn = job.submission.get('assignment') or {}
+        names = (str(asgn.get('id')), asgn.get('name'),
+                 make_dirname(asgn.get('name', '')))
+        ranks = [self.focus.index(name) for name in names
+                 if name in self.focus]
+        return (
+            min(ranks or [len(self.focus)]),
+            asgn.get('due_at') or '9999',
+            job.submission.get('submitted_at') or '9999',
         )
 
-        path = make_dir_path(root, asgn, stu, dir_order)
-        make_directory(path)
+    def push(self, job):
+        """Add a job to the queue."""
+        with self.lock:
+            self.count += 1
+            heapq.heappush(self.heap, (self.priority(job), self.count, job))
+            METRICS.set('grading_queue_depth', len(self.heap))
+
+    def pop(self):
+        """Return the highest priority job, or None if the queue is empty."""
+        self.refresh()
+        with self.lock:
+            if not self.heap:
+                return None
+            job = heapq.heappop(self.heap)[-1]
+            METRICS.set('grading_queue_depth', len(self.heap))
+            return job
+
+    def set_focus(self, focus):
+        """Replace the focus list and reorder the waiting jobs."""
+        with self.lock:
+            self.focus = list(focus)
+            self.heap = [(self.priority(job), count, job)
+                         for _, count, job in self.heap]
+            heapq.heapify(self.heap)
+
+    def refresh(self):
+        """Reload the focus file if it changed since it was last read."""
+        if self.focus_file is None:
+            return
+        try:
+            mtime = os.stat(self.focus_file).st_mtime
+        except OSError:
+            return
+        if mtime != self.focus_mtime:
+            self.focus_mtime = mtime
+            self.set_focus(read_focus_file(self.focus_file))
+
+
+async def git_worker(scheduler, journal):
+    """Run jobs from the scheduler until it is empty."""
+    while True:
+        job = scheduler.pop()
+        if job is None:
+            return
+        await run_git_job(job, journal)
+
+
+def format_progress(jobs):
+    """Return lines of a compact status display for the given jobs."""
+    finished = [job for job in jobs if job.done]
+    active = [job for job in jobs if job.started and not job.done]
+    failed = sum(job.failed for job in finished)
+    lines = ['[{}/{} done, {} active, {} failed]'.format(
+        len(finished), len(jobs), len(active), failed)]
+    for job in active:
+        lines.append('  {:<24.24} {:<9} {:>9} {:>6.1f}s'.format(
+            job.name, job.phase, format_bytes(job.bytes), job.elapsed))
+    return lines
+
+
+async def show_progress(jobs, stream=sys.stdout):
+    """Redraw the status display in place until cancelled."""
+    drawn = 0
+    try:
+        while True:
+            lines = format_progress(jobs)
+            if stream.isatty():
+                if drawn:
+                    stream.write('\x1b[{}F\x1b[J'.format(drawn))
+                stream.write('\n'.join(lines) + '\n')
+                drawn = len(lines)
+            else:
+                stream.write(lines[0] + '\n')
+            stream.flush()
+            await asyncio.sleep(PROGRESS_INTERVAL * (1 + 9 * (not drawn)))
+    except asyncio.CancelledError:
+        if drawn:
+            stream.write('\x1b[{}F\x1b[J'.format(drawn))
+        stream.write('\n'.join(format_progress(jobs)[:1]) + '\n')
+        stream.flush()
+
+
+async def _run_git_jobs(jobs, concurrency, journal, scheduler):
+    """Run all jobs on a pool of workers alongside the display."""
+    if scheduler is None:
+        scheduler = JobScheduler(jobs)
+    display = asyncio.ensure_future(show_progress(jobs))
+    try:
+        await asyncio.gather(
+            *(git_worker(scheduler, journal) for _ in range(concurrency)))
+    finally:
+        display.cancel()
+        await asyncio.gather(display, return_exceptions=True)
+
+
+def run_git_jobs(jobs, concurrency=DEFAULT_CONCURRENCY, journal=None,
+                 scheduler=None):
+    """Run the git steps of all jobs with bounded concurrency.
+
+    Jobs are taken from the scheduler, or in due date order if none is
+    given. State transitions are recorded in the journal if one is given.
+    """
+    asyncio.run(_run_git_jobs(jobs, concurrency, journal, scheduler))
+    return jobs
+
+
+def print_summary(jobs, stream=sys.stdout):
+    """Print a table of finished jobs, slowest first."""
+    stream.write('----------' * 5 + '\n')
+    stream.write('{:>8} {:>9} {:<6} {}\n'.format(
+        'seconds', 'bytes', 'status', 'student'))
+    for job in sorted(jobs, key=lambda job: job.elapsed, reverse=True):
+        status = 'FAIL' if job.failed else 'ok'
+        stream.write('{:>8.1f} {:>9} {:<6} {}\n'.format(
+            job.elapsed, format_bytes(job.bytes), status, job.name))
+
+
+def job_report(job, root, retries=0):
+    """Return a JSON-ready record of one finished job."""
+    lines = [line for line in job.stderr.splitlines() if line.strip()]
+    return {
+        'key': job.key,
+        'student': job.name,
+        'assignment': (job.submission.get('assignment') or {}).get('name'),
+        'path': os.path.relpath(job.path, root),
+        'mode': job.mode,
+        'status': 'failed' if job.failed else 'ok',
+        'cause': failure_cause(job.stderr) if job.failed else None,
+        'error': lines[-1][-200:] if job.failed and lines else None,
+        'seconds': round(job.elapsed, 3),
+        'bytes': job.bytes,
+        'retries': retries,
+    }
+
+
+def run_report(jobs, root, journal=None):
+    """Return a report of every job in a run with totals by status and cause.
+
+    Retries count earlier attempts at the same submission recorded in the
+    journal, from previous runs or workers.
+    """
+    attempts = journal.attempts() if journal is not None else {}
+    records = [job_report(job, root, max(attempts.get(job.key, 1) - 1, 0))
+               for job in jobs]
+    causes = defaultdict(int)
+    for record in records:
+        if record['cause']:
+            causes[record['cause']] += 1
+    started = [job.started for job in jobs if job.started]
+    finished = [job.finished for job in jobs if job.finished]
+    return {
+        'root': root,
+        'started': min(started) if started else None,
+        'finished': max(finished) if finished else None,
+        'totals': {
+            'jobs': len(records),
+            'ok': sum(record['status'] == 'ok' for record in records),
+            'failed': sum(record['status'] == 'failed' for record in records),
+            'causes': dict(causes),
+            'bytes': sum(record['bytes'] for record in records),
+            'seconds': round(sum(record['seconds'] for record in records), 3),
+            'retries': sum(record['retries'] for record in records),
+        },
+        'jobs': records,
+    }
+
+
+def job_key(submission):
+    """Return a key identifying one attempt of a submission."""
+    return '{}-{}'.format(submission['id'], submission.get('attempt'))
+
+
+class JobJournal(object):
+    """Append-only log of job state transitions, one JSON object per line."""
+
+    def __init__(self, path):
+        """Initialize with the path of the journal file."""
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, key, state, **info):
+        """Append a state transition for the job with the given key."""
+        if state not in JOB_STATES:
+            raise ValueError('Unknown job state: {}'.format(state))
+        info.update(job=key, state=state, time=time.time())
+        line = json.dumps(info, sort_keys=True) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def states(self):
+        """Return dict of the last recorded state of each job."""
+        states = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn final line from an interrupted write.
+                        continue
+                    states[entry['job']] = entry['state']
+        except IOError:
+            pass
+        return states
+
+    def attempts(self):
+        """Return dict of how many times each job has been started."""
+        attempts = defaultdict(int)
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry['state'] == 'cloning':
+                        attempts[entry['job']] += 1
+        except IOError:
+            pass
+        return dict(attempts)
+
+
+def is_checkout(path):
+    """Return whether path holds a git checkout."""
+    return os.path.isdir(os.path.join(path, '.git'))
+
+
+def reset_directory(path):
+    """Remove anything a previous attempt left in path."""
+    shutil.rmtree(path, ignore_errors=True)
+    os.mkdir(path)
+
+
+class Manifest(object):
+    """Record of every checkout under the grading root.
+
+    Entries are keyed by path relative to the root and hold the job key,
+    repo url, state ('cloned', 'graded', 'archived' or 'evicted'), last
+    access time, bytes on disk, and the transfer size, duration and fetch
+    mode of the last clone.
+    """
+
+    def __init__(self, root):
+        """Load the manifest of the given grading root."""
+        self.root = root
+        self.path = os.path.join(root, MANIFEST_NAME)
+        self.entries = read_cache(self.path) or {}
+
+    def save(self):
+        """Write the manifest back to disk."""
+        write_cache(self.path, self.entries)
+
+    def relpath(self, path):
+        """Return the manifest key of a checkout path."""
+        return os.path.relpath(path, self.root)
+
+    def record(self, job):
+        """Record a finished clone job."""
+        if job.failed:
+            return
+        self.entries[self.relpath(job.path)] = {
+            'key': job.key,
+            'repo_url': parse_repo_url(job.submission['url'])[0]
+            if job.submission.get('url') else None,
+            'state': 'cloned',
+            'last_access': time.time(),
+            'disk_bytes': dir_size(job.path),
+            'bytes': job.bytes,
+            'seconds': round(job.elapsed, 3),
+            'mode': job.mode,
+        }
+
+    def mark_graded(self, submissions):
+        """Mark checkouts of submissions that no longer need grading."""
+        graded = set(job_key(sub) for sub in submissions
+                     if not needs_grading(sub))
+        for entry in self.entries.values():
+            if entry['state'] == 'cloned' and entry['key'] in graded:
+                entry['state'] = 'graded'
+
+    def last_access(self, relpath):
+        """Return latest of recorded and filesystem access times."""
+        entry = self.entries[relpath]
+        try:
+            atime = os.stat(os.path.join(self.root, relpath)).st_atime
+        except OSError:
+            atime = 0
+        return max(entry['last_access'], atime)
+
+    def disk_bytes(self):
+        """Return total bytes of checkouts still on disk."""
+        return sum(entry['disk_bytes'] for entry in self.entries.values()
+                   if entry['state'] in ('cloned', 'graded'))
+
+
+def archive_checkout(path, bundle):
+    """Save all refs of the checkout at path into a git bundle.
+
+    Return the name of the branch that was checked out.
+    """
+    os.makedirs(os.path.dirname(bundle), exist_ok=True)
+    branch = subprocess.check_output(
+        ['git', 'rev-parse', '--abbrev-ref', 'HEAD'], cwd=path)
+    subprocess.check_call(
+        ['git', 'bundle', 'create', '--quiet', bundle, '--all'],
+        cwd=path, stdin=DEVNULL, stdout=DEVNULL)
+    return branch.decode('utf-8').strip()
+
+
+def enforce_disk_budget(manifest, budget, reserve=0, keep=(), archive=False):
+    """Evict least recently used graded checkouts until under budget.
+
+    reserve is room to leave for the coming clone batch, and paths in keep
+    are never evicted. With archive, git checkouts are saved as bundles
+    that restore_checkout can bring back. Return the evicted paths.
+    """
+    keep = set(manifest.relpath(path) for path in keep)
+    graded = [relpath for relpath, entry in manifest.entries.items()
+              if entry['state'] == 'graded' and relpath not in keep]
+    graded.sort(key=manifest.last_access)
+    evicted = []
+    used = manifest.disk_bytes()
+    for relpath in graded:
+        if used + reserve <= budget:
+            break
+        entry = manifest.entries[relpath]
+        path = os.path.join(manifest.root, relpath)
+        if archive and os.path.isdir(os.path.join(path, '.git')):
+            bundle = os.path.join(manifest.root, ARCHIVE_NAME,
+                                  relpath + '.bundle')
+            branch = archive_checkout(path, bundle)
+            entry.update(state='archived', bundle=bundle, branch=branch)
+        else:
+            entry['state'] = 'evicted'
+        shutil.rmtree(path, ignore_errors=True)
+        used -= entry['disk_bytes']
+        evicted.append(path)
+    manifest.save()
+    return evicted
+
+
+def restore_checkout(manifest, path):
+    """Restore an archived checkout from its bundle."""
+    entry = manifest.entries[manifest.relpath(path)]
+    if entry['state'] != 'archived':
+        raise ValueError('{} is not archived.'.format(path))
+    shutil.rmtree(path, ignore_errors=True)
+    subprocess.check_call(['git', 'clone', '--quiet', entry['bundle'], path])
+    subprocess.check_call(
+        ['git', 'checkout', '--quiet', entry.pop('branch')], cwd=path)
+    subprocess.check_call(
+        ['git', 'remote', 'set-url', 'origin', entry['repo_url']], cwd=path)
+    os.remove(entry.pop('bundle'))
+    entry.update(state='graded', last_access=time.time())
+    manifest.save()
+
+
+def run_standard_tests(path, assignment_name, timeout=TEST_TIMEOUT,
+                       root=None):
+    """Run the matching standard suite against the checkout at path.
+
+    Module and class names are matched to the checkout, and to the root's
+    names config when the grading root is given, as in batch_tests.py.
+    Return dict with the suite name, pytest return code and summary line.
+    """
+    with span('find suite', 'test'):
+        suite = find_suite(make_dirname(assignment_name))
+    if suite is None:
+        return {'suite': None, 'returncode': None, 'summary': 'no suite'}
+    try:
+        with span('environment', 'test', lane=path):
+            python = ENVS.python(path) if ENVS else sys.executable
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        return {'suite': os.path.basename(suite), 'returncode': None,
+                'summary': 'environment failed: {}'.format(e)}
+    key = os.path.relpath(path, root) if root else None
+    names = submission_names(path, suite, key,
+                             read_names_config(root) if root else None)
+    with span('pytest', 'test', lane=path, suite=suite):
+        return run_suite(path, suite, names, python, timeout)
+
+
+class JobQueue(object):
+    """Shared SQLite queue of clone/test jobs with leases.
+
+    Workers claim a job for LEASE_SECONDS at a time and renew the lease
+    while they work, so jobs of a worker that dies are claimed again once
+    their lease runs out. Put the database on storage every worker can
+    reach; it stands in for a real broker.
+    """
+
+    def __init__(self, path):
+        """Open or create the queue database at path."""
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                due TEXT NOT NULL,
+                submitted TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT
+            )""")
+
+    def publish(self, key, payload, priority):
+        """Add a job unless one with the same key was already published."""
+        self.db.execute(
+            'INSERT OR IGNORE INTO jobs (key, payload, rank, due, submitted) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, json.dumps(payload)) + tuple(priority))
+
+    def claim(self, worker, lease=LEASE_SECONDS):
+        """Claim the next runnable job; return (key, payload) or None."""
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.expire(now)
+            row = self.db.execute(
+                "SELECT key, payload FROM jobs WHERE attempts < ? AND "
+                "(state = 'queued' OR (state = 'claimed' AND lease_until < ?))"
+                " ORDER BY rank, due, submitted LIMIT 1",
+                (MAX_ATTEMPTS, now)).fetchone()
+            if row is not None:
+                self.db.execute(
+                    "UPDATE jobs SET state = 'claimed', worker = ?, "
+                    "lease_until = ?, attempts = attempts + 1 WHERE key = ?",
+                    (worker, now + lease, row[0]))
+            self.db.execute('COMMIT')
+        except sqlite3.Error:
+            self.db.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def expire(self, now=None):
+        """Fail claimed jobs whose lease ran out on their last attempt."""
+        self.db.execute(
+            "UPDATE jobs SET state = 'failed', result = ?, lease_until = NULL "
+            "WHERE state = 'claimed' AND lease_until < ? AND attempts >= ?",
+            (json.dumps({'error': 'lease expired'}),
+             time.time() if now is None else now, MAX_ATTEMPTS))
+
+    def renew(self, key, worker, lease=LEASE_SECONDS):
+        """Extend the lease on a claimed job; return whether still owned."""
+        cursor = self.db.execute(
+            "UPDATE jobs SET lease_until = ? WHERE key = ? AND worker = ? "
+            "AND state = 'claimed'", (time.time() + lease, key, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, key, worker, result, failed=False):
+        """Record the result of a job this worker still owns."""
+        state = 'failed' if failed else 'done'
+        self.db.execute(
+            "UPDATE jobs SET state = ?, result = ?, lease_until = NULL "
+            "WHERE key = ? AND worker = ? AND state = 'claimed'",
+            (state, json.dumps(result), key, worker))
+
+    def pending(self):
+        """Return number of jobs not yet done or failed."""
+        self.expire()
+        return self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'claimed')"
+            ).fetchone()[0]
+
+    def counts(self):
+        """Return dict of number of jobs in each state."""
+        self.expire()
+        return dict(self.db.execute(
+            'SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def results(self):
+        """Yield (key, state, worker, result dict) of finished jobs."""
+        rows = self.db.execute(
+            "SELECT key, state, worker, result FROM jobs "
+            "WHERE result IS NOT NULL ORDER BY key")
+        for key, state, worker, result in rows:
+            yield key, state, worker, json.loads(result)
+
+    def payload_results(self):
+        """Yield (payload dict, result dict) of finished jobs."""
+        rows = self.db.execute(
+            "SELECT payload, result FROM jobs "
+            "WHERE result IS NOT NULL ORDER BY key")
+        for payload, result in rows:
+            yield json.loads(payload), json.loads(result)
+
+
+def publish_jobs(queue, paths, root, mode, test=False, focus=()):
+    """Publish a job for each (submission, path) pair to the queue."""
+    scheduler = JobScheduler(focus=focus)
+    for sub, path in paths:
+        payload = {
+            'submission': sub,
+            'path': os.path.relpath(path, root),
+            'mode': mode,
+            'test': test,
+        }
+        job = GitJob(sub, sub['user'], path, mode)
+        queue.publish(job.key, payload, scheduler.priority(job))
+
+
+async def keep_lease(queue, key, worker):
+    """Renew a job's lease until cancelled."""
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3.0)
+        queue.renew(key, worker)
+
+
+async def queue_worker(queue, root, worker):
+    """Claim and run jobs from the queue until none are left."""
+    loop = asyncio.get_running_loop()
+    while True:
+        claimed = queue.claim(worker)
+        if claimed is None:
+            if not queue.pending():
+                return
+            # Others hold leases; wait in case one of them expires.
+            await asyncio.sleep(QUEUE_POLL_INTERVAL)
+            continue
+        key, payload = claimed
+        sub = payload['submission']
+        job = GitJob(sub, sub['user'], os.path.join(root, payload['path']),
+                     payload['mode'])
+        make_directories(root, [job.path])
+        reset_directory(job.path)
+        print('{} claimed {}: {}'.format(worker, key, job.name))
+        lease = asyncio.ensure_future(keep_lease(queue, key, worker))
+        try:
+            await run_git_job(job)
+            result = {'seconds': round(job.elapsed, 3), 'bytes': job.bytes,
+                      'error': job.stderr[-500:] if job.failed else None}
+            if payload.get('test') and not job.failed:
+                result['tests'] = await loop.run_in_executor(
+                    None, run_standard_tests, job.path,
+                    sub['assignment']['name'], TEST_TIMEOUT, root)
+        finally:
+            lease.cancel()
+        queue.complete(key, worker, result, job.failed)
+        print('{} finished {}: {}'.format(
+            worker, key, 'FAIL' if job.failed else 'ok'))
+
+
+def run_workers(queue_path, root, concurrency=DEFAULT_CONCURRENCY):
+    """Run concurrent queue workers on this machine until the queue drains."""
+    name = '{}-{}'.format(socket.gethostname(), os.getpid())
+
+    async def workers():
+        queues = [JobQueue(queue_path) for _ in range(concurrency)]
+        await asyncio.gather(*(
+            queue_worker(queue, root, '{}-{}'.format(name, num))
+            for num, queue in enumerate(queues)))
+
+    asyncio.run(workers())
+
+
+def print_queue_status(queue, stream=sys.stdout):
+    """Print job counts by state and the results reported so far."""
+    counts = queue.counts()
+    stream.write(', '.join('{} {}'.format(count, state)
+                           for state, count in sorted(counts.items())) + '\n')
+    for key, state, worker, result in queue.results():
+        tests = (result.get('tests') or {}).get('summary', '')
+        stream.write('{:<16} {:<6} {:<24} {}\n'.format(
+            key, state, worker, tests))
+
+
+def parse_canvas_time(stamp):
+    """Return epoch seconds of a Canvas timestamp, or None."""
+    if not stamp:
+        return None
+    return calendar.timegm(
+        datetime.strptime(stamp, CANVAS_TIME_FORMAT).timetuple())
+
+
+def predict_warm_targets(course_id, window_hours=WARM_WINDOW_HOURS,
+                         now=None):
+    """Return sorted repo urls likely to be graded in the next window.
+
+    Assignments due within the window on either side of now are targets.
+    For each student, repos they submitted to any assignment in the same
+    module as a target are included, since students usually keep working
+    in one repo per module.
+    """
+    now = time.time() if now is None else now
+    window = window_hours * 3600
+    index = load_module_index(course_id)
+    siblings = defaultdict(set)
+    for assignment_id, module in index.items():
+        siblings[module['id']].add(int(assignment_id))
+    targets = set()
+    for asgn in get_course_assignments(course_id):
+        due = parse_canvas_time(asgn.get('due_at'))
+        if due is not None and abs(due - now) <= window:
+            module = index.get(str(asgn['id']))
+            targets.update(siblings[module['id']] if module else ())
+            targets.add(asgn['id'])
+
+    repos = set()
+    for sub in get_course_submissions(course_id):
+        if sub['assignment_id'] in targets and is_git_repo(sub):
+            repos.add(parse_repo_url(sub['url'])[0])
+    return sorted(repos)
+
+
+def dir_size(path):
+    """Return total size in bytes of the files below path."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+def update_mirror(repo_url):
+    """Create or refresh the local mirror of a repo; return bytes added."""
+    mirror = mirror_path(repo_url)
+    before = dir_size(mirror)
+    if os.path.isdir(mirror):
+        start = time.time()
+        subprocess.check_call(['git', '--git-dir', mirror, 'fetch', '--prune',
+                               '--quiet', 'origin'], stdin=DEVNULL,
+                              env=GIT_ENV)
+        record_mirror_fetch(mirror, time.time() - start)
+    else:
+        os.makedirs(os.path.dirname(mirror), exist_ok=True)
+        subprocess.check_call(['git', 'clone', '--mirror', '--quiet',
+                               repo_url, mirror], stdin=DEVNULL,
+                              env=GIT_ENV)
+    return max(dir_size(mirror) - before, 0)
+
+
+def list_mirrors():
+    """Return paths of all repo mirrors in the local git cache."""
+    return sorted(glob.glob(os.path.join(GIT_CACHE_DIR, '*', '*.git')))
+
+
+def mirror_stats(mirror):
+    """Return the fetch and maintenance history stored in a mirror."""
+    stats = read_cache(os.path.join(mirror, MIRROR_STATS_NAME)) or {}
+    stats.setdefault('fetches', [])
+    stats.setdefault('maintenance', [])
+    return stats
+
+
+def record_mirror_fetch(mirror, seconds):
+    """Add a fetch duration to a mirror's history."""
+    stats = mirror_stats(mirror)
+    stats['fetches'].append({'time': time.time(), 'seconds': seconds})
+    del stats['fetches'][:-FETCH_HISTORY]
+    write_cache(os.path.join(mirror, MIRROR_STATS_NAME), stats)
+
+
+def count_objects(mirror):
+    """Return dict of git count-objects -v figures for a mirror."""
+    output = subprocess.check_output(
+        ['git', '--git-dir', mirror, 'count-objects', '-v'])
+    counts = {}
+    for line in output.decode('utf-8').splitlines():
+        key, _, value = line.partition(':')
+        counts[key.strip()] = int(value)
+    return counts
+
+
+def maintenance_score(mirror):
+    """Return how overdue a mirror is for maintenance; 1 or more is due.
+
+    Counts fetches since the last maintenance, loose objects and packs,
+    each relative to its threshold.
+    """
+    stats = mirror_stats(mirror)
+    last = stats['maintenance'][-1]['time'] if stats['maintenance'] else 0
+    fetches = sum(fetch['time'] > last for fetch in stats['fetches'])
+    counts = count_objects(mirror)
+    return max(
+        fetches / float(MAINTENANCE_FETCHES),
+        counts.get('count', 0) / float(MAINTENANCE_LOOSE_OBJECTS),
+        counts.get('packs', 0) / float(MAINTENANCE_PACKS),
+    )
+
+
+def maintain_mirror(mirror):
+    """Repack, write the commit-graph and prune unreachable objects."""
+    before = count_objects(mirror)
+    start = time.time()
+    for args in (['repack', '-a', '-d', '-l', '-q'],
+                 ['commit-graph', 'write', '--reachable', '--changed-paths'],
+                 ['prune'],
+                 ['pack-refs', '--all']):
+        subprocess.check_call(['git', '--git-dir', mirror] + args,
+                              stdin=DEVNULL, stdout=DEVNULL)
+    after = count_objects(mirror)
+    stats = mirror_stats(mirror)
+    stats['maintenance'].append({
+        'time': time.time(),
+        'seconds': round(time.time() - start, 3),
+        'before': before,
+        'after': after,
+    })
+    del stats['maintenance'][:-FETCH_HISTORY]
+    write_cache(os.path.join(mirror, MIRROR_STATS_NAME), stats)
+
+
+def average(values):
+    """Return the mean of a list of numbers, or None if it is empty."""
+    return sum(values) / float(len(values)) if values else None
+
+
+def fetch_timing(stats):
+    """Return mean fetch seconds before and after the last maintenance."""
+    if not stats['maintenance']:
+        return None, None
+    last = stats['maintenance'][-1]['time']
+    before = [f['seconds'] for f in stats['fetches'] if f['time'] < last]
+    after = [f['seconds'] for f in stats['fetches'] if f['time'] > last]
+    return average(before), average(after)
+
+
+def run_maintenance(interval_minutes=MAINTENANCE_INTERVAL_MINUTES):
+    """Maintain due mirrors, most overdue first, every interval.
+
+    Runs at low CPU priority; an interval of 0 makes a single pass.
+    """
+    os.nice(WARM_NICENESS)
+    while True:
+        scored = []
+        for mirror in list_mirrors():
+            try:
+                scored.append((maintenance_score(mirror), mirror))
+            except (OSError, subprocess.CalledProcessError):
+                continue
+        for score, mirror in sorted(scored, reverse=True):
+            if score < 1:
+                break
+            try:
+                maintain_mirror(mirror)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print('maintenance of {} failed: {}'.format(mirror, e))
+                continue
+            print('maintained {}'.format(os.path.relpath(mirror,
+                                                         GIT_CACHE_DIR)))
+        if not interval_minutes:
+            return
+        time.sleep(interval_minutes * 60)
+
+
+def print_maintenance_report(stream=sys.stdout):
+    """Print object counts and fetch timings around the last maintenance."""
+    stream.write('{:<40} {:>6} {:>6} {:>8} {:>8}\n'.format(
+        'mirror', 'loose', 'packs', 'before', 'after'))
+    for mirror in list_mirrors():
+        counts = count_objects(mirror)
+        before, after = fetch_timing(mirror_stats(mirror))
+        stream.write('{:<40.40} {:>6} {:>6} {:>8} {:>8}\n'.format(
+            os.path.relpath(mirror, GIT_CACHE_DIR), counts.get('count', 0),
+            counts.get('packs', 0),
+            '-' if before is None else '{:.2f}s'.format(before),
+            '-' if after is None else '{:.2f}s'.format(after)))
+
+
+def warm_cache(course_id, window_hours=WARM_WINDOW_HOURS,
+               bandwidth=WARM_BANDWIDTH):
+    """Pre-populate Canvas and git caches for the coming grading window.
+
+    Runs at low CPU priority and fetches one repo at a time, pausing after
+    each so the average transfer rate stays under bandwidth bytes/second.
+    """
+    os.nice(WARM_NICENESS)
+    repos = predict_warm_targets(course_id, window_hours)
+    print('warming {} repos'.format(len(repos)))
+    for num, repo_url in enumerate(repos, 1):
+        start = time.time()
+        try:
+            added = update_mirror(repo_url)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('[{}/{}] {} failed: {}'.format(num, len(repos), repo_url, e))
+            continue
+        elapsed = time.time() - start
+        print('[{}/{}] {} +{} in {:.1f}s'.format(
+            num, len(repos), repo_url, format_bytes(added), elapsed))
+        time.sleep(max(added / float(bandwidth) - elapsed, 0))
+
+
+def make_room(manifest, disk_budget, count, keep=(), archive=False):
+    """Evict graded checkouts to leave room for count more checkouts.
+
+    disk_budget is in GB; each new checkout is expected to take the mean
+    size of those in the manifest. Return the evicted paths.
+    """
+    sizes = [entry['disk_bytes'] for entry in manifest.entries.values()]
+    reserve = count * sum(sizes) / max(len(sizes), 1)
+    return enforce_disk_budget(manifest, float(disk_budget) * 1024 ** 3,
+                               reserve, keep, archive)
+
+
+def run_clone_batch(jobs, manifest, journal=None,
+                    concurrency=DEFAULT_CONCURRENCY, scheduler=None,
+                    disk_budget=None, archive=False):
+    """Make room under the disk budget, run jobs and record them."""
+    if disk_budget:
+        evicted = make_room(manifest, disk_budget, len(jobs),
+                            [job.path for job in jobs], archive)
+        print('evicted {} graded checkouts'.format(len(evicted)))
+
+    with span('git jobs'):
+        run_git_jobs(jobs, concurrency, journal, scheduler)
+    for job in jobs:
+        manifest.record(job)
+    manifest.save()
+
+
+PlannedJob = namedtuple(
+    'PlannedJob', ('action', 'job', 'bytes', 'seconds', 'source'))
+
+
+class CostModel(object):
+    """Transfer size and duration history of past clones, per repo.
+
+    Repos cloned before are estimated from their own last clone; others,
+    and uploads, which have no repo, from the median of every clone in
+    the same fetch mode.
+    """
+
+    def __init__(self, manifest):
+        """Collect the history recorded in a manifest."""
+        self.by_repo = {}
+        self.by_mode = defaultdict(list)
+        for entry in manifest.entries.values():
+            if 'bytes' not in entry:
+                continue
+            mode = entry.get('mode', 'clone')
+            sample = (entry['bytes'], entry['seconds'])
+            if entry.get('repo_url'):
+                self.by_repo[entry['repo_url'], mode] = sample
+            self.by_mode[mode].append(sample)
+
+    def estimate(self, repo_url, mode):
+        """Return (bytes, seconds, source) expected for one clone."""
+        if (repo_url, mode) in self.by_repo:
+            return self.by_repo[repo_url, mode] + ('repo', )
+        samples = self.by_mode[mode]
+        if not samples:
+            return 0, 0.0, 'none'
+        median = len(samples) // 2
+        return (sorted(num for num, _ in samples)[median],
+                sorted(sec for _, sec in samples)[median], 'median')
+
+
+def plan_jobs(plan, manifest, states, mode=DEFAULT_FETCH_MODE, focus=()):
+    """Return a PlannedJob for each path of a layout, in run order.
+
+    Jobs already cloned according to states are skipped, and paths
+    holding a git checkout the run will keep are refreshed in place. The
+    rest, including tarball and upload jobs, which download everything
+    again, are new.
+    """
+    model = CostModel(manifest)
+    scheduler = JobScheduler(focus=focus)
+    planned = []
+    for sub, path in plan.paths:
+        job = GitJob(sub, sub['user'], path, mode)
+        if states.get(job.key) == 'cloned':
+            planned.append(PlannedJob('skip', job, 0, 0.0, None))
+            continue
+        # Interrupted and failed clones are reset before they run again.
+        kept = states.get(job.key) not in ('cloning', 'failed')
+        action = 'refresh' if job.mode == 'clone' and kept and \
+            is_checkout(path) else 'new'
+        repo_url = parse_repo_url(sub['url'])[0] if sub.get('url') else None
+        planned.append(PlannedJob(action, job,
+                                  *model.estimate(repo_url, job.mode)))
+    planned.sort(key=lambda item: scheduler.priority(item.job))
+    return planned
+
+
+def estimate_wall_time(seconds, concurrency):
+    """Return run time of jobs handed in order to concurrent workers."""
+    workers = [0.0] * max(concurrency, 1)
+    for duration in seconds:
+        heapq.heappush(workers, heapq.heappop(workers) + duration)
+    return max(workers)
+
+
+def print_cost_plan(planned, concurrency=DEFAULT_CONCURRENCY,
+                    stream=sys.stdout):
+    """Print planned jobs with estimated transfer and wall time."""
+    stream.write('{:<8} {:>9} {:>8} {:<6} {}\n'.format(
+        'action', 'bytes', 'seconds', 'from', 'submission'))
+    for item in planned:
+        stream.write('{:<8} {:>9} {:>8.1f} {:<6} {}: {}\n'.format(
+            item.action, format_bytes(item.bytes), item.seconds,
+            item.source or '-', item.job.submission['assignment']['name'],
+            item.job.name))
+
+    actions = defaultdict(int)
+    sources = defaultdict(int)
+    for item in planned:
+        actions[item.action] += 1
+        if item.source:
+            sources[item.source] += 1
+    work = [item.seconds for item in planned if item.action != 'skip']
+    stream.write('{} jobs: {} new, {} refresh, {} skip\n'.format(
+        len(planned), actions['new'], actions['refresh'], actions['skip']))
+    stream.write('estimated from: {} repo history, {} course median, '
+                 '{} no history\n'.format(
+                     sources['repo'], sources['median'], sources['none']))
+    stream.write('estimated transfer {}, {:.0f}s of clone time\n'.format(
+        format_bytes(sum(item.bytes for item in planned)), sum(work)))
+    for jobs in sorted(set(PLAN_CONCURRENCY + (concurrency, ))):
+        stream.write('  -j {:<3} {:>8.0f}s{}\n'.format(
+            jobs, estimate_wall_time(work, jobs),
+            '  <- current' if jobs == concurrency else ''))
+
+
+class StreamingLayout(object):
+    """Assign directory paths to submissions one at a time.
+
+    Unlike plan_layout, collisions are only known as they stream in: the
+    first assignment or student seen with a slug keeps it, and later ones
+    with the same slug get their Canvas id appended.
+    """
+
+    def __init__(self, root, dir_order, modules=None):
+        """Initialize with the grading root and directory order."""
+        self.root = root
+        self.dir_order = dir_order
+        self.modules = modules
+        self.owners = {}
+        self.collisions = defaultdict(set)
+
+    def path(self, sub):
+        """Return the target path of a submission."""
+        items = dir_path_items(sub['assignment'], sub['user'],
+                               self.dir_order, self.modules)
+        names = []
+        for char, item in zip(self.dir_order, items):
+            slug = item_dirname(item)
+            owner = self.owners.setdefault((char, slug), item.get('id'))
+            if owner != item.get('id'):
+                self.collisions[char, slug].update((owner, item.get('id')))
+                slug = '-'.join((slug, str(item.get('id'))))
+            names.append(slug)
+        return os.path.join(self.root, *names)
+
+
+class QueueStats(object):
+    """Depth samples and wait times of a queue between pipeline stages.
+
+    Long put waits mean the consuming stage is the bottleneck; long get
+    waits mean the producing stage is.
+    """
+
+    def __init__(self, name, queue):
+        """Initialize with a display name and the queue to watch."""
+        self.name = name
+        self.queue = queue
+        self.samples = 0
+        self.depth_total = 0
+        self.max_depth = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def sample(self):
+        """Record the current queue depth."""
+        depth = self.queue.qsize()
+        self.samples += 1
+        self.depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+        METRICS.set('grading_pipeline_queue_depth', depth, stage=self.name)
+
+    async def put(self, item):
+        """Put an item on the queue, timing any backpressure."""
+        start = time.time()
+        await self.queue.put(item)
+        self.put_wait += time.time() - start
+
+    async def get(self):
+        """Get an item from the queue, timing any starvation."""
+        start = time.time()
+        item = await self.queue.get()
+        self.get_wait += time.time() - start
+        return item
+
+    @property
+    def mean_depth(self):
+        """Return the mean sampled depth."""
+        return self.depth_total / float(self.samples or 1)
+
+
+# Graded submissions the filter stage saw pile up in graded until the
+# plan stage marks them in the manifest.
+DiskBudget = namedtuple('DiskBudget',
+                        ('manifest', 'gigabytes', 'archive', 'graded'))
+
+
+async def fetch_stage(sink, course_id):
+    """Page through course submissions onto a queue.
+
+    Each next() runs in a thread, so the next page is requested while
+    later stages work, but no sooner than the queue has room for it.
+    """
+    loop = asyncio.get_running_loop()
+    pages = iter(get_course_submissions(course_id))
+    while True:
+        sub = await loop.run_in_executor(None, next, pages, None)
+        await sink.put(sub)
+        if sub is None:
+            return
+
+
+async def filter_stage(source, sink, graded=None):
+    """Pass on submissions that need grading and can be fetched.
+
+    Submissions that no longer need grading are added to graded, if given.
+    """
+    while True:
+        sub = await source.get()
+        if sub is None:
+            await sink.put(None)
+            return
+        if not needs_grading(sub):
+            if graded is not None:
+                graded.append(sub)
+        elif is_fetchable(sub):
+            await sink.put(sub)
+
+
+async def plan_stage(source, sink, layout, jobs, fetch_mode, journal,
+                     states, scheduler, workers, budget=None):
+    """Give each submission a directory and queue a job, by priority.
+
+    With a DiskBudget, graded checkouts are evicted to make room before
+    each job is queued.
+    """
+    count = 0
+    while True:
+        sub = await source.get()
+        if sub is None:
+            break
+        path = layout.path(sub)
+        state = states.get(job_key(sub))
+        if state == 'cloned':
+            continue
+        if budget is not None:
+            budget.manifest.mark_graded(budget.graded)
+            del budget.graded[:]
+            # Jobs of this run are only recorded once it ends.
+            make_room(budget.manifest, budget.gigabytes, len(jobs) + 1,
+                      [job.path for job in jobs] + [path], budget.archive)
+        os.makedirs(path, exist_ok=True)
+        if state in ('cloning', 'failed') and not is_upload(sub):
+            reset_directory(path)
+        journal.record(job_key(sub), 'planned', path=path)
+        job = GitJob(sub, sub['user'], path, fetch_mode)
+        jobs.append(job)
+        count += 1
+        await sink.put((scheduler.priority(job), count, job))
+    for num in range(workers):
+        await sink.put(((float('inf'), ), count + num + 1, None))
+
+
+async def clone_stage(source, journal):
+    """Run queued jobs until the end marker arrives."""
+    while True:
+        job = (await source.get())[-1]
+        if job is None:
+            return
+        await run_git_job(job, journal)
+
+
+async def sample_stages(stages):
+    """Sample every queue's depth until cancelled."""
+    while True:
+        for stats in stages:
+            stats.sample()
+        await asyncio.sleep(PROGRESS_INTERVAL)
+
+
+async def _run_pipeline(course_id, layout, fetch_mode, concurrency, journal,
+                        states, scheduler, budget):
+    """Connect the pipeline stages with bounded queues and run them."""
+    stages = [
+        QueueStats('fetch', asyncio.Queue(PIPELINE_QUEUE_SIZE)),
+        QueueStats('filter', asyncio.Queue(PIPELINE_QUEUE_SIZE)),
+        QueueStats('clone', asyncio.PriorityQueue(PIPELINE_QUEUE_SIZE)),
+    ]
+    fetched, filtered, planned = stages
+    jobs = []
+    sampler = asyncio.ensure_future(sample_stages(stages))
+    display = asyncio.ensure_future(show_progress(jobs))
+    try:
+        await asyncio.gather(
+            fetch_stage(fetched, course_id),
+            filter_stage(fetched, filtered,
+                         budget.graded if budget is not None else None),
+            plan_stage(filtered, planned, layout, jobs, fetch_mode, journal,
+                       states, scheduler, concurrency, budget),
+            *(clone_stage(planned, journal) for _ in range(concurrency)))
+    finally:
+        for task in (sampler, display):
+            task.cancel()
+        await asyncio.gather(sampler, display, return_exceptions=True)
+    return jobs, stages
+
+
+def run_pipeline(course_id, layout, fetch_mode=DEFAULT_FETCH_MODE,
+                 concurrency=DEFAULT_CONCURRENCY, journal=None, states=None,
+                 scheduler=None, manifest=None, disk_budget=None,
+                 archive=False):
+    """Fetch, filter, plan and clone submissions with overlapping stages.
+
+    Pages keep being fetched while repos clone, and bounded queues
+    between the stages keep memory flat. With disk_budget, checkouts of
+    graded submissions in manifest are evicted as room is needed. Return
+    the jobs and the QueueStats of each stage.
+    """
+    return asyncio.run(_run_pipeline(
+        course_id, layout, fetch_mode, concurrency, journal, states or {},
+        scheduler or JobScheduler(),
+        DiskBudget(manifest, disk_budget, archive, []) if disk_budget
+        else None))
+
+
+def print_pipeline_stats(stages, stream=sys.stdout):
+    """Print queue depths and wait times of each pipeline stage."""
+    stream.write('{:<8} {:>6} {:>6} {:>10} {:>10}\n'.format(
+        'queue', 'mean', 'max', 'put wait', 'get wait'))
+    for stats in stages:
+        stream.write('{:<8} {:>6.1f} {:>6} {:>9.1f}s {:>9.1f}s\n'.format(
+            stats.name, stats.mean_depth, stats.max_depth, stats.put_wait,
+            stats.get_wait))
+
+
+class SubmissionStore(object):
+    """SQLite store of the latest known version of each submission."""
+
+    def __init__(self, path):
+        """Open or create the store at path."""
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS submissions (
+                id INTEGER PRIMARY KEY,
+                assignment_id INTEGER,
+                user_id INTEGER,
+                attempt INTEGER,
+                submitted_at TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );""")
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(submissions)')]
+        if 'version' not in columns:
+            # Stores from before grading changes were tracked.
+            with self.db:
+                self.db.execute(
+                    'ALTER TABLE submissions ADD COLUMN version TEXT')
+
+    def update(self, submissions):
+        """Store submissions; return those that are new or changed.
+
+        A submission changes when it is resubmitted or its grade changes.
+        """
+        changed = []
+        with self.db:
+            for sub in submissions:
+                row = self.db.execute(
+                    'SELECT version FROM submissions WHERE id = ?',
+                    (sub['id'], )).fetchone()
+                version = json.dumps([sub.get(field)
+                                      for field in VERSION_FIELDS])
+                if row is not None and row[0] == version:
+                    continue
+                self.db.execute(
+                    'INSERT OR REPLACE INTO submissions (id, assignment_id, '
+                    'user_id, attempt, submitted_at, data, version) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (sub['id'], sub.get('assignment_id'), sub.get('user_id'),
+                     sub.get('attempt'), sub.get('submitted_at'),
+                     json.dumps(sub), version))
+                changed.append(sub)
+        return changed
+
+    def submissions(self):
+        """Yield every stored submission dict."""
+        for (data, ) in self.db.execute('SELECT data FROM submissions'):
+            yield json.loads(data)
+
+    def get_meta(self, key, default=None):
+        """Return a stored sync setting."""
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key, )).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        """Store a sync setting."""
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                            (key, value))
+
+
+def read_submissions_export(path):
+    """Yield submission dicts from a submissions CSV export, row by row.
+
+    Columns are submission fields, with assignment.<field> and
+    user.<field> filling the nested dicts the API includes; empty cells
+    and missing EXPORT_DEFAULTS columns are None. id, assignment_id and
+    user_id are required.
+    """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        missing = [name for name in EXPORT_REQUIRED if name not in header]
+        if missing:
+            raise ValueError('{} is missing columns: {}'.format(
+                path, ', '.join(missing)))
+        # Work out each column's target once rather than per row.
+        columns = []
+        for column in header:
+            parent, _, field = column.rpartition('.')
+            columns.append((parent, field or column,
+                            EXPORT_TYPES.get(column, str)))
+        for row in reader:
+            sub = dict.fromkeys(EXPORT_DEFAULTS)
+            sub.update(assignment={}, user={})
+            for (parent, field, convert), value in zip(columns, row):
+                target = sub[parent] if parent else sub
+                target[field] = convert(value) if value else None
+            sub['assignment'].setdefault('id', sub['assignment_id'])
+            sub['user'].setdefault('id', sub['user_id'])
+            yield sub
+
+
+def bootstrap_store(store, path):
+    """Load a submissions export into the store and set the sync cursor.
+
+    Later syncs only ask Canvas for submissions made, or graded, after
+    the newest submission or grade in the export. Return the number of
+    submissions loaded.
+    """
+    submitted, graded = [], []
+
+    def rows():
+        for sub in read_submissions_export(path):
+            if sub['submitted_at']:
+                submitted.append(sub['submitted_at'])
+            if sub['graded_at']:
+                graded.append(sub['graded_at'])
+            yield sub
+
+    with span('bootstrap', path=path):
+        loaded = len(store.update(rows()))
+    since = store.get_meta('submitted_since')
+    if submitted:
+        store.set_meta('submitted_since', max(submitted + [since or '']))
+    # Anything graded before the export was taken is in it, and nothing
+    # in it was graded after that, so either kind of stamp bounds it.
+    if submitted or graded:
+        store.set_meta('graded_since', max(
+            submitted + graded + [store.get_meta('graded_since') or '']))
+    return loaded
+
+
+def prune_cache(max_age=CACHE_MAX_AGE):
+    """Delete response cache files not written for max_age seconds."""
+    cutoff = time.time() - max_age
+    for path in glob.glob(os.path.join(CACHE_DIR, '*.json')):
         try:
-            get_git_repo(sub, stu, path)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
         except OSError:
-            fail_list.append(path)
+            pass
+
+
+def sync_submissions(store, course_id):
+    """Fetch submissions made or graded since the stored cursors.
+
+    Return the new and changed submissions. A store without cursors is
+    filled with every submission. The cursors only move when something
+    new arrives, so unchanged polls repeat the same conditional requests
+    and are answered with a 304.
+    """
+    since = store.get_meta('submitted_since')
+    graded = store.get_meta('graded_since') or since
+    if since is None:
+        changed = store.update(get_course_submissions(course_id))
+    else:
+        changed = store.update(get_course_submissions(
+            course_id, submitted_since=since))
+        changed += store.update(get_course_submissions(
+            course_id, graded_since=graded))
+    submitted = [sub['submitted_at'] for sub in changed
+                 if sub.get('submitted_at')]
+    if submitted:
+        store.set_meta('submitted_since', max(submitted + [since or '']))
+    stamps = [sub['graded_at'] for sub in changed if sub.get('graded_at')]
+    if stamps:
+        store.set_meta('graded_since', max(stamps + [graded or '']))
+    return changed
+
+
+def watch(root, dir_order, fetch_mode=DEFAULT_FETCH_MODE,
+          concurrency=DEFAULT_CONCURRENCY, test=False, disk_budget=None,
+          archive=False, similarity=False):
+    """Clone new and resubmitted GitHub submissions as they arrive.
+
+    Polls every WATCH_MIN_INTERVAL seconds after activity, backing off to
+    WATCH_MAX_INTERVAL while nothing changes. Jobs the journal shows as
+    failed or interrupted, in this session or an earlier one, are retried
+    with the next poll until they have been started MAX_ATTEMPTS times.
+    State lives in the submission store, journal and manifest on disk, so
+    memory use does not grow with uptime. SIGINT or SIGTERM stops after
+    the current batch.
+    """
+    os.makedirs(root, exist_ok=True)
+    store = SubmissionStore(os.path.join(root, STORE_NAME))
+    journal = JobJournal(os.path.join(root, JOURNAL_NAME))
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop.set())
+
+    interval = WATCH_MIN_INTERVAL
+    # Unfinished journal keys that no longer need cloning, such as graded
+    # or superseded submissions; they are not looked at again.
+    stale = set()
+    while not stop.is_set():
+        try:
+            changed = sync_submissions(store, COURSE_ID)
+        except (requests.RequestException, ValueError) as e:
+            print('poll failed: {}'.format(e))
+            changed = []
+        keys = set(job_key(sub) for sub in changed
+                   if needs_grading(sub) and is_fetchable(sub))
+        attempts = journal.attempts()
+        retry = set(key for key, state in journal.states().items()
+                    if state in ('planned', 'cloning', 'failed') and
+                    attempts.get(key, 0) < MAX_ATTEMPTS) - stale
+        # Retries alone do not count as activity, so polling still backs off.
+        interval = WATCH_MIN_INTERVAL if keys else \
+            min(interval * WATCH_BACKOFF, WATCH_MAX_INTERVAL)
+        if keys or retry:
+            keys |= retry
+            manifest = Manifest(root)
+            keys -= set(entry['key'] for entry in manifest.entries.values()
+                        if entry['state'] in ('cloned', 'graded'))
+            submissions = list(store.submissions())
+            # Graded checkouts are what the disk budget may evict.
+            manifest.mark_graded(submissions)
+            github = [sub for sub in submissions
+                      if needs_grading(sub) and is_fetchable(sub)]
+            modules = load_module_index(COURSE_ID) if 'm' in dir_order \
+                else None
+            plan = plan_layout(github, root, dir_order, modules)
+            todo = [(sub, path) for sub, path in plan.paths
+                    if job_key(sub) in keys]
+            stale |= retry - set(job_key(sub) for sub, path in todo)
+            make_directories(root, [path for sub, path in todo])
+            jobs = []
+            for sub, path in todo:
+                reset_directory(path)
+                journal.record(job_key(sub), 'planned', path=path)
+                jobs.append(GitJob(sub, sub['user'], path, fetch_mode))
+            run_clone_batch(jobs, manifest, journal, concurrency,
+                            disk_budget=disk_budget, archive=archive)
+            for job in jobs:
+                lag = time.time() - (parse_canvas_time(
+                    job.submission.get('submitted_at')) or time.time())
+                print('{} ready {:.0f}s after submission: {}'.format(
+                    job.name, lag, 'FAIL' if job.failed else job.path))
+                if test and not job.failed:
+                    result = run_standard_tests(
+                        job.path, job.submission['assignment']['name'],
+                        root=root)
+                    print('  {}: {}'.format(result['suite'],
+                                            result['summary']))
+            if similarity:
+                update_similarity(root, [job.path for job in jobs
+                                         if not job.failed])
+        prune_cache()
+        stop.wait(interval)
+    print('watch stopped')
+
+
+def tests_grade(tests):
+    """Return the percent grade of a standard test result, or None."""
+    counts = defaultdict(int)
+    for num, outcome in PYTEST_COUNT_PAT.findall(tests.get('summary', '')):
+        counts[outcome] += int(num)
+    total = sum(counts.values())
+    if not total:
+        return None
+    return '{:g}%'.format(round(100.0 * counts['passed'] / total, 1))
+
+
+def queue_grade_entries(queue):
+    """Return grade entries for the tested jobs of a queue."""
+    entries = []
+    for payload, result in queue.payload_results():
+        tests = result.get('tests')
+        if not tests or tests['suite'] is None:
+            continue
+        sub = payload['submission']
+        entries.append({
+            'assignment_id': sub['assignment']['id'],
+            'student_id': sub['user_id'],
+            'grade': tests_grade(tests),
+            'comment': '{}: {}'.format(tests['suite'], tests['summary']),
+        })
+    return entries
+
+
+def read_grade_entries(source):
+    """Return grade entries from a CSV file or a job queue database.
+
+    A CSV needs assignment_id and student_id columns and may have grade
+    and comment columns; a queue gives the standard test results.
+    """
+    if not source.endswith('.csv'):
+        return queue_grade_entries(JobQueue(source))
+    with open(source, newline='') as f:
+        return [dict((key, row.get(key) or None) for key in GRADE_CSV_FIELDS)
+                for row in csv.DictReader(f)]
+
+
+def grade_form(entries):
+    """Return update_grades form data for a list of grade entries."""
+    data = {}
+    for entry in entries:
+        prefix = 'grade_data[{}][{}]'.format(entry['assignment_id'],
+                                             entry['student_id'])
+        if entry.get('grade') is not None:
+            data[prefix + '[posted_grade]'] = entry['grade']
+        if entry.get('comment'):
+            data[prefix + '[text_comment]'] = entry['comment']
+    return data
+
+
+def post_grades(course_id, entries):
+    """Start a bulk grade update; return its Canvas progress dict."""
+    url = '/'.join((API_ROOT, 'courses', course_id, 'submissions',
+                    'update_grades'))
+    with span('update_grades', 'api', entries=len(entries)):
+        response = requests.post(url, params={'access_token': TOKEN},
+                                 data=grade_form(entries))
+    record_api_response(response)
+    response.raise_for_status()
+    return response.json()
+
+
+def wait_for_progress(progress, interval=GRADE_POLL_INTERVAL):
+    """Poll a Canvas progress object until it completes or fails."""
+    while progress['workflow_state'] in ('queued', 'running'):
+        time.sleep(interval)
+        response = requests.get(progress['url'],
+                                params={'access_token': TOKEN})
+        record_api_response(response)
+        response.raise_for_status()
+        progress = response.json()
+    return progress
+
+
+def check_applied(course_id, entries):
+    """Read back a failed batch; return (applied, retry) entries.
+
+    Canvas applies a batch's entries one by one before failing it, so
+    some of them may already be saved. An entry counts as applied when
+    its grade is the entered grade and its comment is on the submission.
+    Retries leave out comments already posted, since a comment sent
+    twice is posted twice.
+    """
+    params = {
+        'assignment_ids[]': sorted(set(str(entry['assignment_id'])
+                                       for entry in entries)),
+        'student_ids[]': sorted(set(str(entry['student_id'])
+                                    for entry in entries)),
+        'include[]': ['submission_comments'],
+    }
+    with span('read back grades', 'api', entries=len(entries)):
+        subs = dict(((str(sub['assignment_id']), str(sub['user_id'])), sub)
+                    for sub in joined_api_request(
+                        API_ROOT, 'courses', course_id, 'students',
+                        'submissions', **params))
+    applied, retry = [], []
+    for entry in entries:
+        sub = subs.get((str(entry['assignment_id']),
+                        str(entry['student_id']))) or {}
+        graded = entry.get('grade') is None or str(entry['grade']) in (
+            sub.get('entered_grade'), sub.get('grade'))
+        commented = not entry.get('comment') or entry['comment'] in [
+            comment.get('comment')
+            for comment in sub.get('submission_comments') or ()]
+        if graded and commented:
+            applied.append(entry)
+        elif commented:
+            retry.append(dict(entry, comment=None))
+        else:
+            retry.append(entry)
+    return applied, retry
+
+
+def upload_grades(course_id, entries, batch_size=GRADE_BATCH_SIZE,
+                  interval=GRADE_POLL_INTERVAL, stream=sys.stdout):
+    """Post grades and comments in batches through update_grades.
+
+    Every batch is started before any is polled, so Canvas works on them
+    together. A failed batch is read back so only the entries it did not
+    apply are retried, split in half, which narrows retries down to the
+    failing entries; a single entry is given up after failing
+    MAX_ATTEMPTS times. Return the list of given up entries.
+    """
+    pending = [(entries[num:num + batch_size], 1, False)
+               for num in range(0, len(entries), batch_size)]
+    uploaded = 0
+    given_up = []
+
+    def give_up(batch):
+        given_up.extend(batch)
+        METRICS.inc('canvas_grade_entries_total', len(batch),
+                    outcome='failed')
+
+    while pending:
+        started = []
+        retrying = []
+        for batch, attempt, failed_before in pending:
+            if failed_before:
+                try:
+                    applied, batch = check_applied(course_id, batch)
+                except requests.RequestException as e:
+                    # Resending blindly could post comments twice.
+                    stream.write('reading back batch of {} failed: {}\n'
+                                 .format(len(batch), e))
+                    if attempt < MAX_ATTEMPTS:
+                        retrying.append((batch, attempt + 1, True))
+                    else:
+                        give_up(batch)
+                    continue
+                uploaded += len(applied)
+                METRICS.inc('canvas_grade_entries_total', len(applied),
+                            outcome='uploaded')
+                if not batch:
+                    continue
+            try:
+                progress = post_grades(course_id, batch)
+            except requests.RequestException as e:
+                progress = {'workflow_state': 'failed', 'message': str(e)}
+            started.append((batch, attempt, progress))
+        pending = retrying
+        for batch, attempt, progress in started:
+            try:
+                progress = wait_for_progress(progress, interval)
+            except requests.RequestException as e:
+                progress = {'workflow_state': 'failed', 'message': str(e)}
+            if progress['workflow_state'] == 'completed':
+                uploaded += len(batch)
+                METRICS.inc('canvas_grade_entries_total', len(batch),
+                            outcome='uploaded')
+                continue
+            stream.write('batch of {} failed (attempt {}): {}\n'.format(
+                len(batch), attempt, progress.get('message')))
+            if len(batch) > 1:
+                half = len(batch) // 2
+                pending.extend(((batch[:half], attempt, True),
+                                (batch[half:], attempt, True)))
+            elif attempt < MAX_ATTEMPTS:
+                pending.append((batch, attempt + 1, True))
+            else:
+                give_up(batch)
+        stream.write('[{}/{} grades uploaded, {} retrying, {} failed]\n'.format(
+            uploaded, len(entries), sum(len(batch) for batch, _, _ in pending),
+            len(given_up)))
+    return given_up
+
+
+def write_grade_entries(path, entries):
+    """Write grade entries to a CSV file that --upload-grades can read."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, GRADE_CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(entries)
+
+
+def write_run_report(path, report):
+    """Write a run report as JSON for later tooling."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp, path)
+
+
+def print_failures(report, stream=sys.stdout):
+    """Print failure counts by cause and one line per failed job.
+
+    Failures are mostly submissions without a valid PR (bad_url or
+    missing_ref).
+    """
+    totals = report['totals']
+    failed = [record for record in report['jobs']
+              if record['status'] == 'failed']
+    stream.write('----------' * 5 + '\n')
+    stream.write('FAILURES: {} of {} jobs ({})\n'.format(
+        totals['failed'], totals['jobs'], ', '.join(
+            '{} {}'.format(count, cause) for cause, count in
+            sorted(totals['causes'].items(), key=lambda item: -item[1]))))
+    for record in sorted(failed, key=lambda record: record['cause']):
+        stream.write('{:<12} {:>6.1f}s {:>2}x  {}\n'.format(
+            record['cause'], record['seconds'], record['retries'] + 1,
+            record['path']))
+        if record['error']:
+            stream.write('{:<12} {}\n'.format('', record['error']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('dir_order', nargs='?', default=DEFAULT_DIR_ORDER,
+                        choices=DIR_ORDERS,
+                        help='directory order acronym (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_CONCURRENCY,
+                        help='number of repos to clone at once')
+    parser.add_argument('--fetch-mode', choices=FETCH_MODES,
+                        default=DEFAULT_FETCH_MODE,
+                        help='clone with history, or download only the '
+                        'file tree at the PR head')
+    parser.add_argument('--uploads', action='store_true',
+                        help='also download uploaded-file submissions '
+                        'into their directories')
+    parser.add_argument('--bulk-zip', action='store_true',
+                        help='like --uploads, but get each assignment\'s '
+                        'uploads in one submissions zip')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip jobs the journal records as cloned and '
+                        'retry failed or unfinished ones')
+    parser.add_argument('--focus', metavar='ASSIGNMENTS',
+                        help='comma separated assignment names or ids to '
+                        'clone first')
+    parser.add_argument('--focus-file', metavar='PATH',
+                        help='file of assignment names or ids to clone '
+                        'first, one per line; re-read when edited mid-run')
+    parser.add_argument('--publish', metavar='QUEUE',
+                        help='publish clone jobs to a shared queue database '
+                        'instead of cloning here')
+    parser.add_argument('--worker', metavar='QUEUE',
+                        help='claim and run jobs from a shared queue database')
+    parser.add_argument('--queue-status', metavar='QUEUE',
+                        help='print job states and results of a shared queue')
+    parser.add_argument('--test', action='store_true',
+                        help='run the matching standard tests on each '
+                        'published or watched job after cloning')
+    parser.add_argument('--shared-envs', metavar='DIR', nargs='?',
+                        const=os.path.join(HERE, '.envs'),
+                        help="run tests in environments shared by checkouts "
+                        "with the same requirements, built from a local "
+                        "wheel cache (default: .envs)")
+    parser.add_argument('--offline-envs', action='store_true',
+                        help='with --shared-envs, only use wheels already '
+                        'in the cache')
+    parser.add_argument('--upload-grades', metavar='SOURCE',
+                        help='post grades and comments from a CSV file or '
+                        'the test results of a job queue in bulk, then exit')
+    parser.add_argument('--grade-batch-size', type=int, metavar='N',
+                        default=GRADE_BATCH_SIZE,
+                        help='grade entries per update_grades request')
+    parser.add_argument('--section', action='append', metavar='SECTION',
+                        help='only fetch submissions of this section id or '
+                        "name, or 'mine' for the sections you teach; may be "
+                        'repeated (default: $CANVAS_SECTIONS)')
+    parser.add_argument('--plan', action='store_true',
+                        help='print the jobs a run would do with estimated '
+                        'transfer and wall time, from cached Canvas data '
+                        'and past runs, without running git')
+    parser.add_argument('--similarity', action='store_true',
+                        help='index new checkouts for near-duplicate code '
+                        'and print similar pairs')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='clone while Canvas pages are still being '
+                        'fetched, and report where the pipeline waits')
+    parser.add_argument('--bootstrap', metavar='CSV',
+                        help='load a submissions CSV export into the local '
+                        'store, so later runs only sync newer submissions '
+                        'from Canvas')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep polling Canvas and clone submissions '
+                        'as they arrive')
+    parser.add_argument('--warm', action='store_true',
+                        help='pre-fetch repos and Canvas data for '
+                        'assignments due soon, at low priority')
+    parser.add_argument('--warm-window', type=float, metavar='HOURS',
+                        default=WARM_WINDOW_HOURS,
+                        help='hours around now to look for due dates')
+    parser.add_argument('--warm-bandwidth', type=float, metavar='KIB/S',
+                        default=WARM_BANDWIDTH / 1024,
+                        help='average transfer rate limit while warming')
+    parser.add_argument('--disk-budget', type=float, metavar='GB',
+                        default=DISK_BUDGET_GB,
+                        help='evict least recently used graded checkouts '
+                        'to stay under this size before cloning '
+                        '(default: $GRADING_DISK_BUDGET)')
+    parser.add_argument('--archive', action='store_true',
+                        help='save evicted checkouts as git bundles')
+    parser.add_argument('--restore', metavar='PATH',
+                        help='restore an archived checkout and exit')
+    parser.add_argument('--maintain', type=float, metavar='MINUTES',
+                        nargs='?', const=MAINTENANCE_INTERVAL_MINUTES,
+                        help='repack, write commit-graphs and prune the '
+                        'local git cache every MINUTES (0 for one pass)')
+    parser.add_argument('--maintenance-report', action='store_true',
+                        help='print git cache object counts and fetch times '
+                        'before and after the last maintenance')
+    parser.add_argument('--report', metavar='PATH',
+                        help='write the JSON run report to PATH (default: '
+                        '<root>/{})'.format(REPORT_NAME))
+    parser.add_argument('--profile', metavar='TRACE',
+                        help='write a Chrome trace of every stage and job '
+                        'to TRACE (a .json file)')
+    parser.add_argument('--cprofile', metavar='PATH',
+                        help='with --profile, also dump cProfile stats')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='serve Prometheus metrics at :PORT/metrics')
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help='keep writing Prometheus metrics to PATH')
+    args = parser.parse_args()
+    if args.plan and args.pipeline:
+        # --plan reads stale cached pages; a pipeline run would clone them.
+        parser.error('--plan cannot be combined with --pipeline')
+    if args.profile:
+        start_profiling(args.profile, args.cprofile)
+    start_metrics(args.metrics_port, args.metrics_file)
+
+    root = os.path.join(HERE, DEFAULT_ROOT_NAME)
+    focus = args.focus.split(',') if args.focus else ()
+    if args.plan:
+        REVALIDATE = False
+    if args.section:
+        SECTIONS = args.section
+    FETCH_UPLOADS = args.uploads or args.bulk_zip
+    if args.shared_envs:
+        ENVS = EnvManager(args.shared_envs, args.offline_envs)
+        atexit.register(print_env_stats, ENVS)
+    if args.upload_grades:
+        entries = read_grade_entries(args.upload_grades)
+        failed = upload_grades(COURSE_ID, entries, args.grade_batch_size)
+        if failed:
+            write_grade_entries('failed-grades.csv', failed)
+            print('{} grades not uploaded, saved to failed-grades.csv'.format(
+                len(failed)))
+        sys.exit(1 if failed else 0)
+    if args.worker:
+        run_workers(args.worker, root, args.jobs)
+        print_queue_status(JobQueue(args.worker))
+        sys.exit()
+    if args.queue_status:
+        print_queue_status(JobQueue(args.queue_status))
+        sys.exit()
+    if args.warm:
+        warm_cache(COURSE_ID, args.warm_window, args.warm_bandwidth * 1024)
+        sys.exit()
+    if args.maintain is not None:
+        run_maintenance(args.maintain)
+        sys.exit()
+    if args.maintenance_report:
+        print_maintenance_report()
+        sys.exit()
+    manifest = Manifest(root)
+    if args.restore:
+        restore_checkout(manifest, os.path.abspath(args.restore))
+        sys.exit()
+    store_path = os.path.join(root, STORE_NAME)
+    if args.bootstrap:
+        os.makedirs(root, exist_ok=True)
+        store = SubmissionStore(store_path)
+        print('loaded {} submissions from {}, syncing from {}'.format(
+            bootstrap_store(store, args.bootstrap), args.bootstrap,
+            store.get_meta('submitted_since')))
+    if args.watch:
+        watch(root, args.dir_order, args.fetch_mode, args.jobs, args.test,
+              args.disk_budget, args.archive, args.similarity)
+        sys.exit()
+
+    if args.pipeline:
+        modules = load_module_index(COURSE_ID) \
+            if 'm' in args.dir_order else None
+        journal = JobJournal(os.path.join(root, JOURNAL_NAME))
+        os.makedirs(root, exist_ok=True)
+        kept = manifest.disk_bytes()
+        with span('pipeline'):
+            jobs, stages = run_pipeline(
+                COURSE_ID, StreamingLayout(root, args.dir_order, modules),
+                args.fetch_mode, args.jobs, journal,
+                journal.states() if args.resume else {},
+                JobScheduler(focus=focus, focus_file=args.focus_file),
+                manifest, args.disk_budget, args.archive)
+        if args.disk_budget:
+            print('evicted {} of graded checkouts'.format(
+                format_bytes(kept - manifest.disk_bytes())))
+        for job in jobs:
+            manifest.record(job)
+        manifest.save()
+        print_summary(jobs)
+        print_pipeline_stats(stages)
+        if args.similarity:
+            update_similarity(root, [job.path for job in jobs
+                                     if not job.failed])
+        report = run_report(jobs, root, journal)
+        write_run_report(args.report or os.path.join(root, REPORT_NAME),
+                         report)
+        if report['totals']['failed']:
+            print_failures(report)
+        sys.exit()
+
+    with span('fetch submissions'):
+        if os.path.exists(store_path):
+            # A bootstrapped or watched store only needs the newest pages.
+            store = SubmissionStore(store_path)
+            sync_submissions(store, COURSE_ID)
+            submissions = list(store.submissions())
+        else:
+            submissions = list(get_course_submissions(COURSE_ID))
+    manifest.mark_graded(submissions)
+    with span('filter'):
+        submissions_to_grade = filter(needs_grading, submissions)
+        github_submissions = list(filter(is_fetchable, submissions_to_grade))
+
+    modules = None
+    if 'm' in args.dir_order:
+        with span('module index'):
+            modules = load_module_index(COURSE_ID)
+    with span('plan layout'):
+        plan = plan_layout(github_submissions, root, args.dir_order, modules)
+    if args.plan:
+        journal = JobJournal(os.path.join(root, JOURNAL_NAME))
+        states = journal.states() if args.resume else {}
+        print_plan(plan, [])
+        print_cost_plan(plan_jobs(plan, manifest, states, args.fetch_mode,
+                                  focus), args.jobs)
+        sys.exit()
+    if args.publish:
+        queue = JobQueue(args.publish)
+        publish_jobs(queue, plan.paths, root, args.fetch_mode, args.test,
+                     focus)
+        print_plan(plan, [])
+        print_queue_status(queue)
+        sys.exit()
+
+    journal = JobJournal(os.path.join(root, JOURNAL_NAME))
+    states = journal.states() if args.resume else {}
+    todo = [(sub, path) for sub, path in plan.paths
+            if states.get(job_key(sub)) != 'cloned']
+    with span('mkdir'):
+        created = make_directories(root, [path for sub, path in todo])
+    print_plan(plan, created)
+    if args.resume:
+        print('resuming: {} of {} jobs already cloned'.format(
+            len(plan.paths) - len(todo), len(plan.paths)))
+    unzipped = []
+    if args.bulk_zip:
+        # Uploads missing from their zip fall back to per-file downloads.
+        unzipped, missing = fetch_submission_zips(
+            [(sub, path) for sub, path in todo if is_upload(sub)], journal)
+        todo = [(sub, path) for sub, path in todo
+                if not is_upload(sub)] + missing
+
+    jobs = []
+    for sub, path in todo:
+        print("{}'s submission for {}: {}".format(
+            sub['user']['name'], sub['assignment']['name'],
+            sub['url'] or 'uploaded files')
+        )
+        if states.get(job_key(sub)) in ('cloning', 'failed') and \
+                not is_upload(sub):
+            reset_directory(path)
+        journal.record(job_key(sub), 'planned', path=path)
+        jobs.append(GitJob(sub, sub['user'], path, args.fetch_mode))
+
+    scheduler = JobScheduler(jobs, focus, args.focus_file)
+    run_clone_batch(jobs, manifest, journal, args.jobs, scheduler,
+                    args.disk_budget, args.archive)
+    for job in unzipped:
+        manifest.record(job)
+    manifest.save()
+    jobs += unzipped
+    print_summary(jobs)
+    if args.similarity:
+        update_similarity(root, [job.path for job in jobs if not job.failed])
 
-    if len(fail_list):
-        print_failures(fail_list)
+    report = run_report(jobs, root, journal)
+    write_run_report(args.report or os.path.join(root, REPORT_NAME), report)
+    if report['totals']['failed']:
+        print_failures(report)
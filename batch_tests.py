@@ -0,0 +1,372 @@
+"""Run the standard test suites against every cloned submission.
+
+Checkouts are found under <root>/<assignment>/<student> and each
+assignment is matched to its test_*_standard.py. The suites read their
+module, class and attribute names from $STANDARD_<NAME> (see
+cases.configured), so each submission is run with its own names, taken
+from, in order of precedence:
+
+    <root>/test-names.json      {"<assignment>/<student>": {"NAME": "value"}}
+                                where keys may be glob patterns
+    the checkout                the module defining the suite's class
+    the suite                   its defaults
+
+Submissions run in parallel, the slowest in past runs first, and the
+results of all of them go into <root>/.test-report.json.
+
+Usage:
+    python batch_tests.py [ROOT] [-j N] [--assignment SLUG]
+"""
+
+from __future__ import unicode_literals
+import os
+import re
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+from fnmatch import fnmatch
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from envs import EnvManager, print_env_stats
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+DEFAULT_ROOT = os.path.join(HERE, 'grading')
+STANDARD_TESTS_DIR = os.path.join(HERE, 'standard-tests')
+SUITE_ALIASES = {
+    'dll': ('doubly-linked-list', 'dll'),
+    'priorityq': ('priority-queue', 'priorityq'),
+    'sorting': ('sort', ),
+    'tree': ('binary-search-tree', 'bst', 'tree'),
+}
+TEST_TIMEOUT = 300
+DEFAULT_WORKERS = os.cpu_count() or 4
+NAMES_FILE = 'test-names.json'
+HISTORY_NAME = '.test-history.json'
+REPORT_NAME = '.test-report.json'
+PYTEST_COUNT_PAT = re.compile(r'(\d+) (passed|failed|errors?)\b')
+PYTEST_SUMMARY_PAT = re.compile(r'^=*\s*(\d+ \w+.* in [\d.]+s.*?)\s*=*$',
+                                re.MULTILINE)
+SETTING_PAT = re.compile(r"configured\('(\w+)', '([^']*)'\)")
+IGNORED_DIRS = ('__pycache__', 'venv', 'env', 'build', 'dist')
+
+
+def find_suite(slug):
+    """Return path of the standard suite for an assignment slug, or None.
+
+    The suite whose name, or alias, is the longest match inside the
+    slug wins, so 'weighted-graph' beats 'graph'.
+    """
+    best = None, 0
+    for suite in glob.glob(os.path.join(STANDARD_TESTS_DIR, 'test_*.py')):
+        name = os.path.basename(suite)[len('test_'):-len('_standard.py')]
+        aliases = SUITE_ALIASES.get(name, (name.replace('_', '-'), ))
+        for alias in aliases:
+            if alias in slug and len(alias) > best[1]:
+                best = suite, len(alias)
+    return best[0]
+
+
+def suite_settings(suite):
+    """Return dict of the configurable names of a suite and their defaults."""
+    with open(suite) as f:
+        return dict(SETTING_PAT.findall(f.read()))
+
+
+def is_importable(path, module):
+    """Return whether module can be imported from path or path/src."""
+    parts = module.split('.')
+    for base in (path, os.path.join(path, 'src')):
+        stem = os.path.join(base, *parts)
+        if os.path.isfile(stem + '.py') or \
+                os.path.isfile(os.path.join(stem, '__init__.py')):
+            return True
+    return False
+
+
+def module_name(path, filename):
+    """Return the dotted module name of a file in a checkout, or None."""
+    for base in (os.path.join(path, 'src'), path):
+        relpath = os.path.relpath(filename, base)
+        if relpath.startswith(os.pardir):
+            continue
+        parts = relpath[:-len('.py')].split(os.sep)
+        if parts[-1] == '__init__':
+            parts.pop()
+        if parts and all(part.isidentifier() for part in parts):
+            return '.'.join(parts)
+    return None
+
+
+def detect_names(path, settings):
+    """Return names to override when the suite's module is not in path.
+
+    The checkout is searched for a module defining the suite's class,
+    or function for suites without one.
+    """
+    module = settings.get('MODULENAME')
+    target = settings.get('CLASSNAME') or settings.get('FUNCNAME')
+    if module is None or target is None or is_importable(path, module):
+        return {}
+    definition = re.compile(r'^(class|def)\s+{}\b'.format(re.escape(target)),
+                            re.MULTILINE)
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(name for name in dirnames if not
+                             name.startswith('.') and name not in IGNORED_DIRS)
+        for name in sorted(filenames):
+            if not name.endswith('.py') or name.startswith('test_'):
+                continue
+            filename = os.path.join(dirpath, name)
+            try:
+                with open(filename, encoding='utf-8', errors='replace') as f:
+                    found = definition.search(f.read())
+            except OSError:
+                continue
+            if found and module_name(path, filename):
+                return {'MODULENAME': module_name(path, filename)}
+    return {}
+
+
+def read_names_config(root):
+    """Return the per-submission name settings of a grading root."""
+    try:
+        with open(os.path.join(root, NAMES_FILE)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def submission_names(path, suite, key=None, config=None):
+    """Return the names to run a suite with for one submission.
+
+    Only names differing from the suite's defaults are returned: those
+    detected in the checkout, overridden by every matching config entry
+    in file order.
+    """
+    names = detect_names(path, suite_settings(suite))
+    for pattern, settings in (config or {}).items():
+        if key is not None and fnmatch(key, pattern):
+            names.update(settings)
+    return names
+
+
+def run_suite(path, suite, names=None, python=sys.executable,
+              timeout=TEST_TIMEOUT):
+    """Run a standard suite against the checkout at path.
+
+    Return dict with the suite name, pytest return code, summary line
+    and seconds taken.
+    """
+    # pytest runs in the checkout, so relative paths would resolve below it.
+    path, suite = os.path.abspath(path), os.path.abspath(suite)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [path, os.path.join(path, 'src'), STANDARD_TESTS_DIR] +
+        [p for p in [env.get('PYTHONPATH')] if p])
+    for name, value in (names or {}).items():
+        env['STANDARD_' + name] = value
+    start = time.time()
+    try:
+        proc = subprocess.run(
+            [python, '-m', 'pytest', '-q', '-p', 'no:cacheprovider', suite],
+            cwd=path, env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'suite': os.path.basename(suite), 'returncode': None,
+                'summary': 'timed out after {}s'.format(timeout),
+                'seconds': round(time.time() - start, 3)}
+    output = proc.stdout.decode('utf-8', 'replace')
+    summary = PYTEST_SUMMARY_PAT.findall(output)
+    return {
+        'suite': os.path.basename(suite),
+        'returncode': proc.returncode,
+        'summary': summary[-1] if summary else output.strip()[-200:],
+        'seconds': round(time.time() - start, 3),
+    }
+
+
+def summary_counts(summary):
+    """Return dict of passed, failed and errors counts in a summary line."""
+    counts = {'passed': 0, 'failed': 0, 'errors': 0}
+    for num, outcome in PYTEST_COUNT_PAT.findall(summary or ''):
+        counts['errors' if outcome.startswith('error') else outcome] += \
+            int(num)
+    return counts
+
+
+def find_checkouts(root, assignments=()):
+    """Return sorted (assignment, student, path) of checkouts under root."""
+    checkouts = []
+    for assignment in sorted(os.listdir(root)):
+        adir = os.path.join(root, assignment)
+        if assignment.startswith('.') or not os.path.isdir(adir) or \
+                (assignments and assignment not in assignments):
+            continue
+        for student in sorted(os.listdir(adir)):
+            path = os.path.join(adir, student)
+            if not student.startswith('.') and os.path.isdir(path):
+                checkouts.append((assignment, student, path))
+    return checkouts
+
+
+def read_json(path, default):
+    """Return the JSON content of path, or default if missing or torn."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def write_json(path, obj):
+    """Atomically write obj as JSON to path."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp, path)
+
+
+def longest_first(tasks, history):
+    """Return tasks ordered by past duration, longest first.
+
+    Submissions without history are estimated by the mean of their
+    suite, so a new cohort still starts its slow suites early.
+    """
+    by_suite = defaultdict(list)
+    for key, suite, path in tasks:
+        if key in history:
+            by_suite[suite].append(history[key])
+    means = {suite: sum(times) / len(times)
+             for suite, times in by_suite.items()}
+    overall = sum(history.values()) / len(history) if history else 0.0
+    return sorted(tasks, key=lambda task: -history.get(
+        task[0], means.get(task[1], overall)))
+
+
+def run_batch(root, checkouts, workers=DEFAULT_WORKERS, timeout=TEST_TIMEOUT,
+              python_for=None, stream=sys.stdout):
+    """Run every checkout's suite in parallel; return list of results.
+
+    Each pytest run is its own process, so a thread per worker is
+    enough to keep workers processes busy. python_for, if given, maps
+    a checkout path to the interpreter to test it with.
+    """
+    config = read_names_config(root)
+    history_path = os.path.join(root, HISTORY_NAME)
+    history = read_json(history_path, {})
+    results, tasks = [], []
+    for assignment, student, path in checkouts:
+        key = '{}/{}'.format(assignment, student)
+        suite = find_suite(assignment)
+        if suite is None:
+            results.append({'key': key, 'suite': None, 'returncode': None,
+                            'summary': 'no suite', 'seconds': 0.0,
+                            'names': {}})
+        else:
+            tasks.append((key, suite, path))
+
+    def run_one(task):
+        key, suite, path = task
+        names = submission_names(path, suite, key, config)
+        try:
+            python = python_for(path) if python_for else sys.executable
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            result = {'suite': os.path.basename(suite), 'returncode': None,
+                      'summary': 'environment failed: {}'.format(e),
+                      'seconds': 0.0}
+        else:
+            result = run_suite(path, suite, names, python, timeout)
+        result.update(key=key, names=names)
+        return result
+
+    with ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(run_one, task)
+                   for task in longest_first(tasks, history)]
+        for num, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            stream.write('[{}/{}] {:<40} {}\n'.format(
+                num, len(futures), result['key'], result['summary']))
+            stream.flush()
+            results.append(result)
+            if result['seconds']:
+                history[result['key']] = result['seconds']
+    write_json(history_path, history)
+    return sorted(results, key=lambda result: result['key'])
+
+
+def batch_report(results):
+    """Return the results with test counts and totals per assignment."""
+    assignments = defaultdict(lambda: {
+        'submissions': 0, 'ran': 0, 'all_passed': 0, 'passed': 0,
+        'failed': 0, 'errors': 0, 'seconds': 0.0})
+    for result in results:
+        result.update(summary_counts(result['summary']))
+        totals = assignments[result['key'].split('/')[0]]
+        totals['submissions'] += 1
+        totals['seconds'] = round(totals['seconds'] + result['seconds'], 3)
+        if result['returncode'] is not None:
+            totals['ran'] += 1
+            totals['all_passed'] += result['returncode'] == 0
+        for outcome in ('passed', 'failed', 'errors'):
+            totals[outcome] += result[outcome]
+    return {'time': time.time(), 'assignments': dict(assignments),
+            'submissions': results}
+
+
+def print_batch_report(report, stream=sys.stdout):
+    """Print totals per assignment and the submissions not fully passing."""
+    stream.write('----------' * 5 + '\n')
+    stream.write('{:<32} {:>5} {:>5} {:>7} {:>8}\n'.format(
+        'assignment', 'subs', 'ok', 'tests', 'seconds'))
+    for assignment, totals in sorted(report['assignments'].items()):
+        tests = totals['passed'] + totals['failed'] + totals['errors']
+        stream.write('{:<32.32} {:>5} {:>5} {:>7} {:>8.1f}\n'.format(
+            assignment, totals['submissions'], totals['all_passed'],
+            '{:.1%}'.format(totals['passed'] / float(tests))
+            if tests else '-',
+            totals['seconds']))
+    for result in report['submissions']:
+        if result['returncode'] != 0 and result['suite'] is not None:
+            stream.write('  {:<40} {}\n'.format(result['key'],
+                                                result['summary']))
+
+
+def main(argv=None):
+    """Run the standard suites of every checkout under a grading root."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('root', nargs='?', default=DEFAULT_ROOT,
+                        help='grading root (default: %(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='suites to run at once (default: %(default)s)')
+    parser.add_argument('--assignment', action='append', metavar='SLUG',
+                        help='only test this assignment directory; may be '
+                        'repeated')
+    parser.add_argument('--timeout', type=float, default=TEST_TIMEOUT,
+                        help='seconds before a suite run is stopped')
+    parser.add_argument('--shared-envs', metavar='DIR', nargs='?',
+                        const=os.path.join(HERE, '.envs'),
+                        help='run each checkout in a shared environment '
+                        'with its requirements (see envs.py)')
+    parser.add_argument('--report', metavar='PATH',
+                        help='write the JSON report to PATH (default: '
+                        '<root>/{})'.format(REPORT_NAME))
+    args = parser.parse_args(argv)
+
+    python_for = None
+    if args.shared_envs:
+        manager = EnvManager(args.shared_envs)
+        python_for = manager.python
+    checkouts = find_checkouts(args.root, args.assignment or ())
+    results = run_batch(args.root, checkouts, args.workers, args.timeout,
+                        python_for)
+    report = batch_report(results)
+    write_json(args.report or os.path.join(args.root, REPORT_NAME), report)
+    print_batch_report(report)
+    if args.shared_envs:
+        print_env_stats(manager)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Shared Python environments for running the standard tests.
+
+Checkouts with the same requirements share one environment, keyed by a
+hash of the normalized requirements and the Python version. A new
+environment is assembled from a local wheel cache: every wheel is
+installed once into its own package directory, and environments get
+hard links to those files instead of copies, so a package used by many
+environments is on disk once.
+
+    <root>/wheels/                  wheel cache, filled by pip wheel
+    <root>/pkgs/<wheel>/            one installed wheel
+    <root>/<key>/                   environment for one requirements hash
+
+Usage:
+    python envs.py CHECKOUT...      build or reuse environments and report
+"""
+
+from __future__ import unicode_literals
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from urllib.parse import unquote, urlparse
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+DEFAULT_ROOT = os.path.join(HERE, '.envs')
+REQUIREMENTS_NAMES = ('requirements.txt', 'requirements-dev.txt')
+BASE_REQUIREMENTS = ('pytest', )
+READY_NAME = '.ready.json'
+STATS_NAME = 'stats.json'
+# pip options and local paths cannot be keyed or cached; leave them out.
+SKIPPED_REQUIREMENT_PAT = re.compile(r'^(-|\.|/|file:)')
+
+
+def read_requirements(path):
+    """Return the sorted, normalized requirements of a checkout."""
+    requirements = set(BASE_REQUIREMENTS)
+    for name in REQUIREMENTS_NAMES:
+        try:
+            with open(os.path.join(path, name)) as f:
+                lines = f.read().splitlines()
+        except (IOError, UnicodeDecodeError):
+            continue
+        for line in lines:
+            line = line.split(' #')[0].strip()
+            if line and not line.startswith('#') and \
+                    not SKIPPED_REQUIREMENT_PAT.match(line):
+                requirements.add(re.sub(r'\s+', '', line).lower())
+    return sorted(requirements)
+
+
+def requirements_key(requirements):
+    """Return the environment key of a list of requirements."""
+    summary = [list(sys.version_info[:2])] + list(requirements)
+    return hashlib.sha256(
+        json.dumps(summary).encode('utf-8')).hexdigest()[:16]
+
+
+def pip(*args):
+    """Run pip of this interpreter quietly; return its stdout."""
+    return subprocess.check_output(
+        (sys.executable, '-m', 'pip', '--disable-pip-version-check',
+         '--quiet') + args, stdin=subprocess.DEVNULL,
+        env=dict(os.environ, PIP_ROOT_USER_ACTION='ignore'))
+
+
+def link_tree(source, dest):
+    """Hard link every file below source into dest, copying across devices."""
+    for dirpath, dirnames, filenames in os.walk(source):
+        target = os.path.join(dest, os.path.relpath(dirpath, source))
+        os.makedirs(target, exist_ok=True)
+        for name in filenames:
+            src, dst = os.path.join(dirpath, name), os.path.join(target, name)
+            if os.path.lexists(dst):
+                continue
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+
+
+def site_packages(env):
+    """Return the site-packages directory of a virtual environment."""
+    if os.name == 'nt':
+        return os.path.join(env, 'Lib', 'site-packages')
+    return os.path.join(env, 'lib', 'python{}.{}'.format(
+        *sys.version_info[:2]), 'site-packages')
+
+
+def env_python(env):
+    """Return the interpreter of a virtual environment."""
+    if os.name == 'nt':
+        return os.path.join(env, 'Scripts', 'python.exe')
+    return os.path.join(env, 'bin', 'python')
+
+
+class EnvManager(object):
+    """Environments keyed by requirements hash, built from a wheel cache.
+
+    Safe to use from several threads; processes sharing a root never see
+    a half-built environment, since each is built aside and renamed into
+    place.
+    """
+
+    def __init__(self, root=DEFAULT_ROOT, offline=False):
+        """Initialize with the directory holding environments and wheels."""
+        self.root = os.path.abspath(root)
+        self.wheels = os.path.join(self.root, 'wheels')
+        self.pkgs = os.path.join(self.root, 'pkgs')
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.created = []
+        self.reused = 0
+        for path in (self.wheels, self.pkgs):
+            os.makedirs(path, exist_ok=True)
+
+    def key_lock(self, key):
+        """Return the lock guarding one environment."""
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def python(self, path):
+        """Return the interpreter of the environment for a checkout."""
+        requirements = read_requirements(path)
+        key = requirements_key(requirements)
+        env = os.path.join(self.root, key)
+        with self.key_lock(key):
+            if os.path.exists(os.path.join(env, READY_NAME)):
+                with self.lock:
+                    self.reused += 1
+            else:
+                start = time.time()
+                self.build(env, requirements)
+                with self.lock:
+                    self.created.append(time.time() - start)
+        return env_python(env)
+
+    def resolve(self, requirements):
+        """Return paths of the wheels satisfying requirements.
+
+        The wheel cache is tried first; only when it cannot satisfy them
+        are the missing wheels built or downloaded into it, unless offline.
+        """
+        args = ('--find-links', self.wheels) + tuple(requirements)
+        try:
+            output = pip('install', '--dry-run', '--ignore-installed',
+                         '--no-index', '--report', '-', *args)
+        except subprocess.CalledProcessError:
+            if self.offline:
+                raise
+            pip('wheel', '--wheel-dir', self.wheels, *args)
+            output = pip('install', '--dry-run', '--ignore-installed',
+                         '--no-index', '--report', '-', *args)
+        report = json.loads(output.decode('utf-8'))
+        return [unquote(urlparse(item['download_info']['url']).path)
+                for item in report['install']]
+
+    def package_dir(self, wheel):
+        """Return the directory a wheel is installed in, installing it once."""
+        name = os.path.basename(wheel)[:-len('.whl')]
+        dest = os.path.join(self.pkgs, name)
+        if not os.path.isdir(dest):
+            tmp = tempfile.mkdtemp(dir=self.pkgs, prefix='.' + name)
+            pip('install', '--no-deps', '--no-index', '--no-compile',
+                '--target', tmp, wheel)
+            try:
+                os.rename(tmp, dest)
+            except OSError:
+                # Another process installed it first.
+                shutil.rmtree(tmp, ignore_errors=True)
+        return dest
+
+    def build(self, env, requirements):
+        """Assemble an environment from installed wheels, then publish it."""
+        wheels = self.resolve(requirements)
+        tmp = tempfile.mkdtemp(dir=self.root, prefix='.build-')
+        try:
+            subprocess.check_call([sys.executable, '-m', 'venv',
+                                   '--without-pip', tmp])
+            for wheel in wheels:
+                link_tree(self.package_dir(wheel), site_packages(tmp))
+            with open(os.path.join(tmp, READY_NAME), 'w') as f:
+                json.dump({'requirements': requirements,
+                           'wheels': [os.path.basename(w) for w in wheels],
+                           'time': time.time()}, f)
+            try:
+                os.rename(tmp, env)
+            except OSError:
+                pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def stats(self):
+        """Return dict of environments created, creation time and reuse."""
+        with self.lock:
+            created, reused = len(self.created), self.reused
+            seconds = sum(self.created)
+        return {
+            'created': created,
+            'create_seconds': round(seconds, 2),
+            'mean_create_seconds': round(seconds / created, 2)
+            if created else None,
+            'reused': reused,
+            'reuse_rate': round(reused / float(created + reused), 3)
+            if created + reused else None,
+        }
+
+    def save_stats(self):
+        """Add this session's figures to the running totals on disk."""
+        path = os.path.join(self.root, STATS_NAME)
+        try:
+            with open(path) as f:
+                totals = json.load(f)
+        except (IOError, ValueError):
+            totals = {'created': 0, 'create_seconds': 0.0, 'reused': 0}
+        stats = self.stats()
+        for key in totals:
+            totals[key] += stats[key]
+        with open(path, 'w') as f:
+            json.dump(totals, f)
+        return totals
+
+
+def print_env_stats(manager, stream=sys.stdout):
+    """Print environment creation time and reuse for a session."""
+    stats = manager.stats()
+    totals = manager.save_stats()
+    stream.write('environments: {} created in {}s, {} reused'.format(
+        stats['created'], stats['create_seconds'], stats['reused']))
+    if stats['reuse_rate'] is not None:
+        stream.write(' (reuse rate {:.0%})'.format(stats['reuse_rate']))
+    stream.write('\n')
+    stream.write('all sessions: {created} created in {create_seconds:.0f}s, '
+                 '{reused} reused\n'.format(**totals))
+
+
+def main(argv=None):
+    """Build or reuse the environment of each checkout and report."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('checkouts', nargs='+')
+    parser.add_argument('--root', default=DEFAULT_ROOT,
+                        help='environment directory (default: %(default)s)')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use wheels already in the cache')
+    args = parser.parse_args(argv)
+
+    manager = EnvManager(args.root, args.offline)
+    for path in args.checkouts:
+        print('{}: {}'.format(path, manager.python(path)))
+    print_env_stats(manager)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""Caching git smart-HTTP proxy for a team of graders on one network.
+
+Clones and fetches of <upstream>/<owner>/<repo>.git are answered from a
+local mirror store. Each mirror is refreshed from upstream at most once
+per --ttl seconds however many graders ask for it, then served through
+git http-backend. Point auto_canvas at the proxy with:
+
+    export GIT_PROXY_URL=http://<proxy host>:8008
+
+Usage:
+    python git_proxy.py [--store DIR] [--upstream URL] [--port PORT]
+"""
+
+from __future__ import unicode_literals
+import os
+import re
+import json
+import time
+import argparse
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+DEFAULT_STORE = os.path.join(HERE, '.git-cache')
+DEFAULT_UPSTREAM = 'https://github.com'
+DEFAULT_PORT = 8008
+DEFAULT_TTL = 60
+CHUNK_SIZE = 64 * 1024
+REPO_PAT = re.compile(
+    r'^/([\w.-]+)/([\w.-]+?)(?:\.git)?'
+    r'(/(?:info/refs|git-upload-pack|HEAD))$')
+STATS_PATH = '/_stats'
+# Git fails instead of prompting on the terminal for credentials.
+GIT_ENV = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+
+
+def object_bytes(mirror):
+    """Return bytes of packed and loose objects in a repo, 0 if missing."""
+    if not os.path.isdir(mirror):
+        return 0
+    output = subprocess.check_output(
+        ['git', '--git-dir', mirror, 'count-objects', '-v'])
+    counts = dict(line.split(': ') for line in
+                  output.decode('utf-8').splitlines())
+    return (int(counts['size']) + int(counts['size-pack'])) * 1024
+
+
+def read_request_body(handler):
+    """Return the request body, decoding chunked transfer encoding."""
+    if 'chunked' not in handler.headers.get('Transfer-Encoding', ''):
+        length = int(handler.headers.get('Content-Length') or 0)
+        return handler.rfile.read(length) if length else b''
+    chunks = []
+    while True:
+        size = int(handler.rfile.readline().split(b';')[0], 16)
+        if not size:
+            handler.rfile.readline()
+            return b''.join(chunks)
+        chunks.append(handler.rfile.read(size))
+        handler.rfile.readline()
+
+
+def run_http_backend(handler, project_root, path_info):
+    """Answer the request with git http-backend; return body bytes sent."""
+    query = handler.path.partition('?')[2]
+    body = read_request_body(handler)
+    env = dict(
+        os.environ,
+        GIT_PROJECT_ROOT=project_root,
+        GIT_HTTP_EXPORT_ALL='1',
+        PATH_INFO=path_info,
+        QUERY_STRING=query,
+        REQUEST_METHOD=handler.command,
+        CONTENT_TYPE=handler.headers.get('Content-Type', ''),
+        CONTENT_LENGTH=str(len(body)),
+        REMOTE_ADDR=handler.client_address[0],
+    )
+    if handler.headers.get('Content-Encoding'):
+        env['HTTP_CONTENT_ENCODING'] = handler.headers['Content-Encoding']
+    if handler.headers.get('Git-Protocol'):
+        env['GIT_PROTOCOL'] = handler.headers['Git-Protocol']
+    proc = subprocess.Popen(['git', 'http-backend'], env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # Feed the request from a thread so a large response cannot deadlock.
+    feeder = threading.Thread(target=proc.stdin.write, args=(body, ))
+    feeder.start()
+
+    status = 200
+    headers = []
+    for line in iter(proc.stdout.readline, b''):
+        line = line.decode('latin-1').strip()
+        if not line:
+            break
+        key, _, value = line.partition(':')
+        if key.lower() == 'status':
+            status = int(value.split()[0])
+        else:
+            headers.append((key, value.strip()))
+    feeder.join()
+    proc.stdin.close()
+
+    handler.send_response(status)
+    for key, value in headers:
+        handler.send_header(key, value)
+    handler.end_headers()
+    sent = 0
+    for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+        handler.wfile.write(chunk)
+        sent += len(chunk)
+    proc.wait()
+    return sent
+
+
+class MirrorStore(object):
+    """Bare mirrors of upstream repos, refreshed at most once per ttl."""
+
+    def __init__(self, root, upstream, ttl=DEFAULT_TTL):
+        """Initialize with the store directory and upstream base url."""
+        self.root = os.path.abspath(root)
+        self.upstream = upstream.rstrip('/')
+        self.ttl = ttl
+        self.refreshed = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.upstream_bytes = 0
+        self.served_bytes = 0
+        self.refreshes = 0
+
+    def repo_lock(self, name):
+        """Return the lock guarding one mirror."""
+        with self.lock:
+            return self.locks.setdefault(name, threading.Lock())
+
+    def ensure(self, owner, repo):
+        """Create or refresh the mirror of owner/repo if it is stale.
+
+        Concurrent requests for the same repo wait for one refresh.
+        Return the mirror's path relative to the store.
+        """
+        name = '{}/{}.git'.format(owner, repo)
+        mirror = os.path.join(self.root, name)
+        with self.repo_lock(name):
+            if time.time() - self.refreshed.get(name, 0) < self.ttl:
+                return name
+            before = object_bytes(mirror)
+            if os.path.isdir(mirror):
+                args = ['git', '--git-dir', mirror, 'fetch', '--prune',
+                        '--quiet', 'origin']
+            else:
+                os.makedirs(os.path.dirname(mirror), exist_ok=True)
+                args = ['git', 'clone', '--mirror', '--quiet',
+                        '{}/{}'.format(self.upstream, name), mirror]
+            subprocess.check_call(args, stdin=subprocess.DEVNULL,
+                                  env=GIT_ENV)
+            self.refreshed[name] = time.time()
+            with self.lock:
+                self.upstream_bytes += max(object_bytes(mirror) - before, 0)
+                self.refreshes += 1
+        return name
+
+    def add_served(self, num_bytes):
+        """Count bytes sent to clients."""
+        with self.lock:
+            self.served_bytes += num_bytes
+
+    def stats(self):
+        """Return dict of byte counters and the served/upstream ratio."""
+        with self.lock:
+            ratio = self.served_bytes / float(self.upstream_bytes or 1)
+            return {
+                'upstream_bytes': self.upstream_bytes,
+                'served_bytes': self.served_bytes,
+                'refreshes': self.refreshes,
+                'served_per_upstream_byte': round(ratio, 2),
+            }
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    """Serve git clones and fetches from the mirror store."""
+
+    protocol_version = 'HTTP/1.0'
+
+    def send_json(self, obj, status=200):
+        """Send a JSON response body."""
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Serve ref advertisements and the stats page."""
+        if self.path == STATS_PATH:
+            return self.send_json(self.server.store.stats())
+        self.serve_git()
+
+    def do_POST(self):
+        """Serve upload-pack requests."""
+        self.serve_git()
+
+    def serve_git(self):
+        """Refresh the requested mirror if needed and run http-backend."""
+        path = self.path.split('?')[0]
+        match = REPO_PAT.match(path)
+        if match is None or 'receive-pack' in self.path:
+            return self.send_json({'message': 'Not Found'}, 404)
+        owner, repo, rest = match.groups()
+        store = self.server.store
+        try:
+            name = store.ensure(owner, repo)
+        except (OSError, subprocess.CalledProcessError):
+            return self.send_json({'message': 'Upstream fetch failed'}, 502)
+        sent = run_http_backend(self, store.root, '/' + name + rest)
+        store.add_served(sent)
+
+
+def start_proxy(store, port=DEFAULT_PORT):
+    """Start the proxy in a daemon thread; return the server."""
+    server = ThreadingHTTPServer(('0.0.0.0', port), ProxyHandler)
+    server.store = store
+    server.url = 'http://{}:{}'.format(*server.server_address)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    """Run the proxy until interrupted, then print its byte counters."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--store', default=DEFAULT_STORE,
+                        help='mirror directory (default: %(default)s)')
+    parser.add_argument('--upstream', default=DEFAULT_UPSTREAM,
+                        help='base url of the real remote; a local git '
+                        'daemon such as git://localhost works for testing')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--ttl', type=float, default=DEFAULT_TTL,
+                        help='seconds a mirror is served before refreshing')
+    args = parser.parse_args(argv)
+
+    store = MirrorStore(args.store, args.upstream, args.ttl)
+    server = start_proxy(store, args.port)
+    print('proxying {} from {} on port {}'.format(
+        store.upstream, store.root, args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+    print(json.dumps(store.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+"""Near-duplicate detection across cloned student submissions.
+
+The submitted Python files of each checkout are reduced to shingles of
+normalized tokens and a MinHash signature. Signatures are cut into LSH
+bands stored in SQLite, so candidate pairs come from shared buckets
+rather than from comparing every pair, and checkouts are only indexed
+again when their files change. The index lives in the grading root:
+
+    <root>/.similarity.db
+
+Usage:
+    python similarity.py [ROOT] [--threshold 0.8] [--reindex]
+"""
+
+from __future__ import unicode_literals
+import io
+import os
+import re
+import sys
+import json
+import zlib
+import random
+import sqlite3
+import hashlib
+import keyword
+import argparse
+import tokenize
+import subprocess
+from array import array
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+DEFAULT_ROOT = os.path.join(HERE, 'grading')
+INDEX_NAME = '.similarity.db'
+MANIFEST_NAME = '.manifest.json'
+SHINGLE_SIZE = 5
+BANDS = 16
+ROWS = 8
+NUM_PERM = BANDS * ROWS
+PRIME = (1 << 61) - 1
+SEED = 20170901
+DEFAULT_THRESHOLD = 0.8
+# Starter and test files are the same in every repo; leave them out.
+IGNORED_FILE_PAT = re.compile(r'^(test_.*|.*_test|conftest|setup)\.py$')
+IGNORED_DIRS = ('__pycache__', 'venv', 'env', 'build', 'dist')
+SKIPPED_TOKENS = (tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE,
+                  tokenize.ENCODING, tokenize.ENDMARKER)
+
+
+def normalized_tokens(source):
+    """Return tokens of Python source with names and literals generalized.
+
+    Renaming variables or changing constants leaves the result unchanged.
+    Source that does not tokenize gives the tokens read before the error.
+    """
+    tokens = []
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+            if tok.type in SKIPPED_TOKENS:
+                continue
+            if tok.type == tokenize.NAME:
+                tokens.append(tok.string if keyword.iskeyword(tok.string)
+                              else 'ID')
+            elif tok.type == tokenize.STRING:
+                tokens.append('STR')
+            elif tok.type == tokenize.NUMBER:
+                tokens.append('NUM')
+            elif tok.type in (tokenize.INDENT, tokenize.DEDENT):
+                tokens.append(tokenize.tok_name[tok.type])
+            else:
+                tokens.append(tok.string)
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    return tokens
+
+
+def shingles(tokens, size=SHINGLE_SIZE):
+    """Return the set of hashed runs of size consecutive tokens."""
+    return set(
+        zlib.crc32(' '.join(tokens[num:num + size]).encode('utf-8'))
+        for num in range(max(len(tokens) - size + 1, 1)) if tokens)
+
+
+def git(path, *args):
+    """Return stripped stdout of a git command run in path."""
+    return subprocess.check_output(
+        ('git', '-C', path) + args,
+        stderr=subprocess.DEVNULL).decode('utf-8').strip()
+
+
+def submitted_files(path):
+    """Return relative paths of the Python files a submission consists of.
+
+    For git checkouts these are the files added or changed since the
+    commit the submission branched from. Otherwise, or when that leaves
+    nothing, as for a submission of the default branch itself, they are
+    every Python file except tests and setup scripts.
+    """
+    if os.path.isdir(os.path.join(path, '.git')):
+        try:
+            base = git(path, 'merge-base', 'HEAD', 'origin/HEAD')
+            names = git(path, 'diff', '--name-only', '--diff-filter=AM',
+                        base, 'HEAD', '--', '*.py').splitlines()
+            names = sorted(name for name in names if not
+                           IGNORED_FILE_PAT.match(os.path.basename(name)))
+            if names:
+                return names
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    names = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [name for name in dirnames
+                       if not name.startswith('.') and name not in IGNORED_DIRS]
+        for name in filenames:
+            if name.endswith('.py') and not IGNORED_FILE_PAT.match(name):
+                names.append(os.path.relpath(os.path.join(dirpath, name),
+                                             path))
+    return sorted(names)
+
+
+def files_fingerprint(path, names):
+    """Return a hash that changes whenever any of the files change."""
+    stats = []
+    for name in names:
+        try:
+            info = os.stat(os.path.join(path, name))
+            stats.append([name, info.st_size, info.st_mtime])
+        except OSError:
+            pass
+    return hashlib.sha1(json.dumps(stats).encode('utf-8')).hexdigest()
+
+
+def permutations(num=NUM_PERM, seed=SEED):
+    """Return (a, b) coefficients of hashes standing in for permutations.
+
+    They are fixed by the seed so signatures stay comparable across runs.
+    """
+    rand = random.Random(seed)
+    return [(rand.randrange(1, PRIME), rand.randrange(PRIME))
+            for _ in range(num)]
+
+
+PERMUTATIONS = permutations()
+
+
+def minhash(shingle_set, perms=PERMUTATIONS):
+    """Return the MinHash signature of a set of shingles, or None if empty."""
+    if not shingle_set:
+        return None
+    return array('Q', [min([(a * x + b) % PRIME for x in shingle_set])
+                       for a, b in perms])
+
+
+def band_hashes(signature, bands=BANDS, rows=ROWS):
+    """Return one bucket hash per LSH band of a signature."""
+    hashes = []
+    for band in range(bands):
+        digest = hashlib.blake2b(
+            signature[band * rows:(band + 1) * rows].tobytes(),
+            digest_size=8).digest()
+        hashes.append(int.from_bytes(digest, 'little', signed=True))
+    return hashes
+
+
+def estimate_similarity(sig1, sig2):
+    """Return the Jaccard similarity estimated from two signatures."""
+    return sum(x == y for x, y in zip(sig1, sig2)) / float(len(sig1))
+
+
+def checkout_signature(path, names):
+    """Return the signature of the named files of a checkout."""
+    tokens = []
+    for name in names:
+        try:
+            with open(os.path.join(path, name), encoding='utf-8',
+                      errors='replace') as f:
+                tokens.extend(normalized_tokens(f.read()))
+        except OSError:
+            continue
+    return minhash(shingles(tokens))
+
+
+class SimilarityIndex(object):
+    """On-disk MinHash signatures and LSH buckets of checkouts."""
+
+    def __init__(self, path):
+        """Open or create the index database at path."""
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                path TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                signature BLOB
+            );
+            CREATE TABLE IF NOT EXISTS buckets (
+                band INTEGER NOT NULL,
+                hash INTEGER NOT NULL,
+                path TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS bucket_hash ON buckets (band, hash);
+            CREATE INDEX IF NOT EXISTS bucket_path ON buckets (path);""")
+
+    def __len__(self):
+        """Return number of indexed checkouts."""
+        return self.db.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    def signature(self, key):
+        """Return the stored signature of a checkout, or None."""
+        row = self.db.execute('SELECT signature FROM docs WHERE path = ?',
+                              (key, )).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return array('Q', row[0])
+
+    def update(self, root, paths):
+        """Index checkouts whose files changed; return their keys.
+
+        Keys are paths relative to root, so the index survives moving it.
+        """
+        updated = []
+        for path in paths:
+            key = os.path.relpath(path, root)
+            row = self.db.execute('SELECT fingerprint FROM docs WHERE path = ?',
+                                  (key, )).fetchone()
+            names = submitted_files(path)
+            fingerprint = files_fingerprint(path, names)
+            if row is not None and row[0] == fingerprint:
+                continue
+            signature = checkout_signature(path, names)
+            with self.db:
+                self.db.execute('DELETE FROM buckets WHERE path = ?', (key, ))
+                self.db.execute(
+                    'INSERT OR REPLACE INTO docs VALUES (?, ?, ?)',
+                    (key, fingerprint,
+                     signature.tobytes() if signature is not None else None))
+                if signature is not None:
+                    self.db.executemany(
+                        'INSERT INTO buckets VALUES (?, ?, ?)',
+                        [(band, value, key) for band, value in
+                         enumerate(band_hashes(signature))])
+            updated.append(key)
+        return updated
+
+    def remove_missing(self, keep):
+        """Drop checkouts whose keys are not in keep."""
+        keep = set(keep)
+        gone = [key for (key, ) in self.db.execute('SELECT path FROM docs')
+                if key not in keep]
+        with self.db:
+            for key in gone:
+                self.db.execute('DELETE FROM docs WHERE path = ?', (key, ))
+                self.db.execute('DELETE FROM buckets WHERE path = ?', (key, ))
+        return gone
+
+    def candidates(self, key):
+        """Return keys sharing at least one LSH bucket with key."""
+        rows = self.db.execute(
+            'SELECT DISTINCT other.path FROM buckets AS own '
+            'JOIN buckets AS other ON own.band = other.band '
+            'AND own.hash = other.hash '
+            'WHERE own.path = ? AND other.path != ?', (key, key))
+        return [path for (path, ) in rows]
+
+    def similar(self, keys=None, threshold=DEFAULT_THRESHOLD):
+        """Return (similarity, key, other) pairs at or above threshold.
+
+        Only pairs involving keys are checked, or every indexed checkout
+        when keys is None. Most similar pairs come first.
+        """
+        if keys is None:
+            keys = [key for (key, ) in self.db.execute(
+                'SELECT path FROM docs WHERE signature IS NOT NULL')]
+        pairs = {}
+        for key in keys:
+            signature = self.signature(key)
+            if signature is None:
+                continue
+            for other in self.candidates(key):
+                pair = tuple(sorted((key, other)))
+                if pair in pairs:
+                    continue
+                score = estimate_similarity(signature, self.signature(other))
+                if score >= threshold:
+                    pairs[pair] = score
+        return sorted(((score, ) + pair for pair, score in pairs.items()),
+                      reverse=True)
+
+
+def manifest_checkouts(root):
+    """Return paths of checkouts on disk according to the root's manifest."""
+    try:
+        with open(os.path.join(root, MANIFEST_NAME)) as f:
+            entries = json.load(f)
+    except (IOError, ValueError):
+        return []
+    return [os.path.join(root, relpath)
+            for relpath, entry in sorted(entries.items())
+            if entry['state'] in ('cloned', 'graded') and
+            os.path.isdir(os.path.join(root, relpath))]
+
+
+def print_similar(pairs, stream=sys.stdout):
+    """Print near-duplicate pairs, most similar first."""
+    for score, key, other in pairs:
+        stream.write('{:>5.0%}  {}  {}\n'.format(score, key, other))
+
+
+def update_similarity(root, paths, threshold=DEFAULT_THRESHOLD,
+                      stream=sys.stdout):
+    """Index new or changed checkouts and print their near-duplicates."""
+    index = SimilarityIndex(os.path.join(root, INDEX_NAME))
+    updated = index.update(root, paths)
+    pairs = index.similar(updated, threshold)
+    stream.write('similarity: {} checkouts indexed, {} updated, {} similar '
+                 'pairs\n'.format(len(index), len(updated), len(pairs)))
+    print_similar(pairs, stream)
+    return pairs
+
+
+def main(argv=None):
+    """Update the index for every checkout in the manifest and report."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('root', nargs='?', default=DEFAULT_ROOT,
+                        help='grading root (default: %(default)s)')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='estimated Jaccard similarity to report')
+    parser.add_argument('--reindex', action='store_true',
+                        help='drop the index and build it again')
+    args = parser.parse_args(argv)
+
+    path = os.path.join(args.root, INDEX_NAME)
+    if args.reindex and os.path.exists(path):
+        os.remove(path)
+    index = SimilarityIndex(path)
+    checkouts = manifest_checkouts(args.root)
+    index.remove_missing(os.path.relpath(p, args.root) for p in checkouts)
+    updated = index.update(args.root, checkouts)
+    print('{} checkouts indexed, {} updated'.format(len(index), len(updated)))
+    print_similar(index.similar(threshold=args.threshold))
+
+
+if __name__ == '__main__':
+    main()
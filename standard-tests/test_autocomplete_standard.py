@@ -7,9 +7,9 @@ from itertools import chain
 from collections import namedtuple
 from importlib import import_module
 
-from cases import STR_EDGE_CASES
-MODULENAME = 'autocomplete'
-CLASSNAME = 'Autocompleter'
+from cases import STR_EDGE_CASES, configured
+MODULENAME = configured('MODULENAME', 'autocomplete')
+CLASSNAME = configured('CLASSNAME', 'Autocompleter')
 END_CHAR = '$'
 
 module = import_module(MODULENAME)
@@ -5,10 +5,10 @@ import pytest
 from itertools import product
 from collections import namedtuple
 from importlib import import_module
-from cases import TEST_CASES, make_unique_value
+from cases import TEST_CASES, make_unique_value, configured
 
-MODULENAME = 'deque'
-CLASSNAME = 'Deque'
+MODULENAME = configured('MODULENAME', 'deque')
+CLASSNAME = configured('CLASSNAME', 'Deque')
 
 module = import_module(MODULENAME)
 ClassDef = getattr(module, CLASSNAME)
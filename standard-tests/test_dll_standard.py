@@ -5,12 +5,12 @@ from importlib import import_module
 import pytest
 from itertools import product
 from collections import namedtuple
-from cases import TEST_CASES, make_unique_value
+from cases import TEST_CASES, make_unique_value, configured
 
 # These constants are to be modified depending on the particular names and
 # choices made by the students.
-MODULENAME = 'dll'
-CLASSNAME = 'DLL'
+MODULENAME = configured('MODULENAME', 'dll')
+CLASSNAME = configured('CLASSNAME', 'DLL')
 REMOVE_ERROR = ValueError
 
 module = import_module(MODULENAME)
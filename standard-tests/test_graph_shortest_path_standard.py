@@ -13,12 +13,13 @@ from heapq import heappop, heappush
 from importlib import import_module
 from itertools import count, chain, permutations
 from collections import namedtuple
+from cases import configured
 
 
-MODULENAME = 'graph'
-CLASSNAME = 'Graph'
-DIJK_NAME = 'dijkstra'
-ALG2_NAME = 'bellman'
+MODULENAME = configured('MODULENAME', 'graph')
+CLASSNAME = configured('CLASSNAME', 'Graph')
+DIJK_NAME = configured('DIJK_NAME', 'dijkstra')
+ALG2_NAME = configured('ALG2_NAME', 'bellman')
 NOTFOUNDERROR = ValueError
 
 module = import_module(MODULENAME)
@@ -7,9 +7,11 @@ import string
 import pytest
 from itertools import chain, permutations
 from collections import namedtuple
+from importlib import import_module
+from cases import configured
 
-MODULENAME = 'graph'
-CLASSNAME = 'Graph'
+MODULENAME = configured('MODULENAME', 'graph')
+CLASSNAME = configured('CLASSNAME', 'Graph')
 
 module = import_module(MODULENAME)
 ClassDef = getattr(module, CLASSNAME)
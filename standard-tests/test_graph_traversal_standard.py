@@ -6,6 +6,7 @@ import inspect
 from importlib import import_module
 from itertools import repeat, chain, permutations
 from collections import deque, namedtuple, defaultdict
+from cases import configured
 # from test_graph_standard import TEST_CASES
 
 # Same for breadth and depth
@@ -19,8 +20,8 @@ from collections import deque, namedtuple, defaultdict
 #   5-node diamond
 
 
-MODULENAME = 'graph'
-CLASSNAME = 'Graph'
+MODULENAME = configured('MODULENAME', 'graph')
+CLASSNAME = configured('CLASSNAME', 'Graph')
 
 module = import_module(MODULENAME)
 ClassDef = getattr(module, CLASSNAME)
@@ -8,14 +8,15 @@ from collections import namedtuple
 from importlib import import_module
 
 from cases import (
+    configured,
     STR_EDGE_CASES,
     STR_TEST_CASES,
     _make_words,
 )
 
-MODULENAME = 'hash_table'
-CLASSNAME = 'HashTable'
-BUCKETS_ATTR = 'bucket'
+MODULENAME = configured('MODULENAME', 'hash_table')
+CLASSNAME = configured('CLASSNAME', 'HashTable')
+BUCKETS_ATTR = configured('BUCKETS_ATTR', 'bucket')
 GET_ERROR = True
 
 module = import_module(MODULENAME)
@@ -5,6 +5,7 @@ from itertools import product, chain
 from collections import namedtuple
 from importlib import import_module
 from cases import (
+    configured,
     INT_EDGE_CASES,
     INT_TEST_CASES,
     MAX_INT,
@@ -13,8 +14,8 @@ from cases import (
 )
 
 
-MODULENAME = 'heap'
-CLASSNAME = 'Heap'
+MODULENAME = configured('MODULENAME', 'heap')
+CLASSNAME = configured('CLASSNAME', 'Heap')
 # Min heap or max heap. defaults to minheap i.e. MAX == True
 MAX = False
 
@@ -5,15 +5,15 @@ from importlib import import_module
 from itertools import product
 from collections import namedtuple
 import random
-from cases import TEST_CASES, make_unique_value
+from cases import TEST_CASES, make_unique_value, configured
 
 # These constants are to be modified depending on the particular names and
 # choices made by the students.
-MODULENAME = 'linked_list'
-CLASSNAME = 'LinkedList'
-NODE_CLASSNAME = 'Node'
-NODE_VAL_ATTR = 'val'
-HEAD_ATTR = 'head'
+MODULENAME = configured('MODULENAME', 'linked_list')
+CLASSNAME = configured('CLASSNAME', 'LinkedList')
+NODE_CLASSNAME = configured('NODE_CLASSNAME', 'Node')
+NODE_VAL_ATTR = configured('NODE_VAL_ATTR', 'val')
+HEAD_ATTR = configured('HEAD_ATTR', 'head')
 REMOVE_ERROR = ValueError
 
 
@@ -7,6 +7,7 @@ from operator import itemgetter
 from collections import namedtuple
 from itertools import product, repeat, cycle
 from cases import (
+    configured,
     TEST_CASES,
     MAX_INT,
     MIN_INT,
@@ -14,8 +15,8 @@ from cases import (
 )
 
 
-MODULENAME = 'priority_queue'
-CLASSNAME = 'PriorityQueue'
+MODULENAME = configured('MODULENAME', 'priority_queue')
+CLASSNAME = configured('CLASSNAME', 'PriorityQueue')
 # Highest priority when MAX=True
 # Lowest priority first when MAX=False
 MAX = True
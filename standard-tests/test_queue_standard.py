@@ -4,10 +4,10 @@ import pytest
 from importlib import import_module
 from itertools import product
 from collections import namedtuple
-from cases import TEST_CASES, make_unique_value
+from cases import TEST_CASES, make_unique_value, configured
 
-MODULENAME = 'queue'
-CLASSNAME = 'Queue'
+MODULENAME = configured('MODULENAME', 'queue')
+CLASSNAME = configured('CLASSNAME', 'Queue')
 DQ_ERROR = IndexError
 
 module = import_module(MODULENAME)
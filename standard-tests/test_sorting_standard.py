@@ -2,14 +2,14 @@
 from __future__ import unicode_literals
 import pytest
 import random
-from cases import TEST_CASES
+from cases import TEST_CASES, configured
 from importlib import import_module
 
 
 IN_PLACE = True
 STABLE = True
-MODULENAME = 'insertion_sort'
-FUNCNAME = 'insertion_sort'
+MODULENAME = configured('MODULENAME', 'insertion_sort')
+FUNCNAME = configured('FUNCNAME', 'insertion_sort')
 
 
 module = import_module(MODULENAME)
@@ -6,10 +6,11 @@ import pytest
 from importlib import import_module
 from itertools import product, chain
 from collections import namedtuple
+from cases import configured
 
 
-MODULENAME = 'stack'
-CLASSNAME = 'Stack'
+MODULENAME = configured('MODULENAME', 'stack')
+CLASSNAME = configured('CLASSNAME', 'Stack')
 
 module = import_module(MODULENAME)
 ClassDef = getattr(module, CLASSNAME)
@@ -11,7 +11,7 @@ from importlib import import_module
 from collections import namedtuple, deque
 from inspect import isgenerator
 
-from cases import TEST_CASES, MIN_STR, MAX_STR, MIN_INT, MAX_INT
+from cases import TEST_CASES, MIN_STR, MAX_STR, MIN_INT, MAX_INT, configured
 
 
 """
@@ -35,13 +35,13 @@ Balancing:
 
 
 BALANCED = False
-MODULENAME = 'bst'
-CLASSNAME = 'BinarySearchTree'
-ROOT_ATTR = 'root'
-VAL_ATTR = 'Value'
-LEFT_ATTR = 'left'
-RIGHT_ATTR = 'right'
-PARENT_ATTR = 'parent'
+MODULENAME = configured('MODULENAME', 'bst')
+CLASSNAME = configured('CLASSNAME', 'BinarySearchTree')
+ROOT_ATTR = configured('ROOT_ATTR', 'root')
+VAL_ATTR = configured('VAL_ATTR', 'Value')
+LEFT_ATTR = configured('LEFT_ATTR', 'left')
+RIGHT_ATTR = configured('RIGHT_ATTR', 'right')
+PARENT_ATTR = configured('PARENT_ATTR', 'parent')
 
 module = import_module(MODULENAME)
 ClassDef = getattr(module, CLASSNAME)
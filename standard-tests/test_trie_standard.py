@@ -8,11 +8,11 @@ from collections import namedtuple
 from importlib import import_module
 from inspect import isgenerator
 
-from cases import STR_EDGE_CASES
+from cases import STR_EDGE_CASES, configured
 
-MODULENAME = 'trie'
-CLASSNAME = 'Trie'
-ROOT_ATTR = 'root'
+MODULENAME = configured('MODULENAME', 'trie')
+CLASSNAME = configured('CLASSNAME', 'Trie')
+ROOT_ATTR = configured('ROOT_ATTR', 'root')
 END_CHAR = '$'
 REMOVE_ERROR = ValueError
 
@@ -9,9 +9,10 @@ from hashlib import md5
 from importlib import import_module
 from itertools import product, chain, permutations
 from collections import namedtuple
+from cases import configured
 
-MODULENAME = 'graph'
-CLASSNAME = 'Graph'
+MODULENAME = configured('MODULENAME', 'graph')
+CLASSNAME = configured('CLASSNAME', 'Graph')
 NOTFOUNDERROR = ValueError
 
 module = import_module(MODULENAME)
@@ -0,0 +1,389 @@
+"""Local stand-in for the GitHub endpoints used by auto_canvas.
+
+Serves bare repos found under a root directory laid out as
+<root>/<owner>/<repo>.git, with pull requests stored as refs/pull/<n>/head:
+
+    GET /repos/<owner>/<repo>/pulls/<n>         pull request head JSON
+    GET /repos/<owner>/<repo>/tarball/<ref>     gzipped tree at ref
+    /git/<owner>/<repo>.git/...                 git smart HTTP (clone/fetch)
+
+and emulates the Canvas bulk grading workflow, where grades are applied
+by background workers while the client polls a progress object:
+
+    POST /api/v1/courses/<id>/submissions/update_grades
+    GET /api/v1/progress/<id>
+    GET /api/v1/courses/<id>/students/submissions   applied grades, comments
+
+Usage:
+    python standin_server.py serve ROOT [--port PORT]
+    python standin_server.py bench [--repos N] [--size MB] [--commits N]
+    python standin_server.py grades [--entries N] [--batch-size N]
+"""
+
+from __future__ import unicode_literals
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl
+from git_proxy import read_request_body, run_http_backend
+
+PULL_PAT = re.compile(r'^/repos/([^/]+)/([^/]+)/pulls/(\d+)$')
+TARBALL_PAT = re.compile(r'^/repos/([^/]+)/([^/]+)/tarball/(.+)$')
+UPDATE_GRADES_PAT = re.compile(
+    r'^/api/v1/courses/([^/]+)/submissions/update_grades$')
+PROGRESS_PAT = re.compile(r'^/api/v1/progress/(\d+)$')
+SUBMISSIONS_PAT = re.compile(
+    r'^/api/v1/courses/([^/]+)/students/submissions/?$')
+GRADE_DATA_PAT = re.compile(r'^grade_data\[([^]]+)\]\[([^]]+)\]\[(\w+)\]$')
+GRADE_PAT = re.compile(r'^-?[\d.]+%?$')
+GIT_PREFIX = '/git/'
+CHUNK_SIZE = 64 * 1024
+GRADE_WORKERS = 4
+SECONDS_PER_GRADE = 0.002
+
+
+def parse_grade_data(body):
+    """Return dict of (assignment id, student id) to posted fields."""
+    grades = {}
+    for key, value in parse_qsl(body.decode('utf-8')):
+        match = GRADE_DATA_PAT.match(key)
+        if match:
+            assignment_id, student_id, field = match.groups()
+            grades.setdefault((assignment_id, student_id), {})[field] = value
+    return grades
+
+
+class GradeJobs(object):
+    """Background workers applying bulk grade updates, like Canvas jobs.
+
+    Each update_grades request gets a progress object that goes from
+    queued to running to completed, or to failed when a grade is invalid
+    or, with fail_rate, at random. As in Canvas, entries are applied one
+    at a time, so those before the failure stay applied.
+    """
+
+    def __init__(self, url, fail_rate=0.0):
+        """Initialize with the server url used in progress urls."""
+        self.url = url
+        self.fail_rate = fail_rate
+        self.progress = {}
+        self.grades = {}
+        self.comments = defaultdict(list)
+        self.lock = threading.Lock()
+        self.workers = threading.Semaphore(GRADE_WORKERS)
+
+    def start(self, grades):
+        """Queue a grade update; return its progress dict."""
+        with self.lock:
+            progress_id = len(self.progress) + 1
+            progress = {
+                'id': progress_id,
+                'tag': 'submissions_update',
+                'workflow_state': 'queued',
+                'completion': 0,
+                'message': None,
+                'url': '{}/api/v1/progress/{}'.format(self.url, progress_id),
+            }
+            self.progress[progress_id] = progress
+        thread = threading.Thread(target=self.run, args=(progress, grades))
+        thread.daemon = True
+        thread.start()
+        return dict(progress)
+
+    def run(self, progress, grades):
+        """Apply grades in a worker slot, updating the progress dict."""
+        lost_at = random.randrange(len(grades)) \
+            if grades and random.random() < self.fail_rate else None
+        with self.workers:
+            progress['workflow_state'] = 'running'
+            for num, (key, fields) in enumerate(sorted(grades.items())):
+                time.sleep(SECONDS_PER_GRADE)
+                grade = fields.get('posted_grade')
+                if grade is not None and not GRADE_PAT.match(grade):
+                    progress.update(workflow_state='failed',
+                                    message='invalid grade {!r}'.format(grade))
+                    return
+                if num == lost_at:
+                    progress.update(workflow_state='failed',
+                                    message='job worker lost')
+                    return
+                with self.lock:
+                    if grade is not None:
+                        self.grades[key] = grade
+                    if fields.get('text_comment'):
+                        self.comments[key].append(fields['text_comment'])
+                progress['completion'] = 100.0 * (num + 1) / len(grades)
+            progress['workflow_state'] = 'completed'
+
+    def get(self, progress_id):
+        """Return a copy of a progress dict, or None."""
+        progress = self.progress.get(progress_id)
+        return dict(progress) if progress else None
+
+    def submissions(self, assignment_ids, student_ids):
+        """Return submission dicts with the grades and comments applied."""
+        with self.lock:
+            return [{
+                'assignment_id': assignment_id,
+                'user_id': student_id,
+                'entered_grade': self.grades.get((assignment_id, student_id)),
+                'submission_comments': [
+                    {'comment': text} for text in
+                    self.comments.get((assignment_id, student_id), ())],
+            } for assignment_id in assignment_ids
+                for student_id in student_ids]
+
+
+def git_output(git_dir, *args):
+    """Return stripped stdout of a git command run against git_dir."""
+    return subprocess.check_output(
+        ('git', '--git-dir', git_dir) + args).decode('utf-8').strip()
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Answer GitHub API and git smart HTTP requests from local repos."""
+
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, *args):
+        """Keep benchmark output quiet."""
+
+    def repo_dir(self, owner, repo):
+        """Return the bare repo directory for owner/repo."""
+        return os.path.join(self.server.root, owner, repo + '.git')
+
+    def send_json(self, obj, status=200):
+        """Send a JSON response body."""
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Dispatch GET requests."""
+        path = self.path.split('?')[0]
+        if path.startswith(GIT_PREFIX):
+            return self.git_backend()
+        match = PROGRESS_PAT.match(path)
+        if match:
+            progress = self.server.grade_jobs.get(int(match.group(1)))
+            if progress is None:
+                return self.send_json({'message': 'Not Found'}, 404)
+            return self.send_json(progress)
+        if SUBMISSIONS_PAT.match(path):
+            query = parse_qs(self.path.partition('?')[2])
+            return self.send_json(self.server.grade_jobs.submissions(
+                query.get('assignment_ids[]', []),
+                query.get('student_ids[]', [])))
+        match = PULL_PAT.match(path)
+        if match:
+            return self.pull(*match.groups())
+        match = TARBALL_PAT.match(path)
+        if match:
+            return self.tarball(*match.groups())
+        self.send_json({'message': 'Not Found'}, 404)
+
+    def do_POST(self):
+        """Dispatch POST requests."""
+        if self.path.startswith(GIT_PREFIX):
+            return self.git_backend()
+        if UPDATE_GRADES_PAT.match(self.path.split('?')[0]):
+            grades = parse_grade_data(read_request_body(self))
+            return self.send_json(self.server.grade_jobs.start(grades))
+        self.send_json({'message': 'Not Found'}, 404)
+
+    def pull(self, owner, repo, pull_num):
+        """Send the head of a pull request."""
+        git_dir = self.repo_dir(owner, repo)
+        try:
+            sha = git_output(git_dir, 'rev-parse',
+                             'refs/pull/{}/head'.format(pull_num))
+        except (OSError, subprocess.CalledProcessError):
+            return self.send_json({'message': 'Not Found'}, 404)
+        full_name = '/'.join((owner, repo))
+        self.send_json({
+            'number': int(pull_num),
+            'head': {'sha': sha, 'repo': {'full_name': full_name}},
+        })
+
+    def tarball(self, owner, repo, ref):
+        """Stream a gzipped archive of the tree at ref."""
+        git_dir = self.repo_dir(owner, repo)
+        if not os.path.isdir(git_dir):
+            return self.send_json({'message': 'Not Found'}, 404)
+        prefix = '{}-{}-{}/'.format(owner, repo, ref[:7])
+        proc = subprocess.Popen(
+            ['git', '--git-dir', git_dir, 'archive', '--format=tar.gz',
+             '--prefix=' + prefix, ref],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-gzip')
+        self.end_headers()
+        for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+            self.wfile.write(chunk)
+        proc.wait()
+
+    def git_backend(self):
+        """Run git http-backend as a CGI program for this request."""
+        path = self.path.split('?')[0]
+        run_http_backend(self, self.server.root, path[len(GIT_PREFIX) - 1:])
+
+
+def start_server(root, port=0, fail_rate=0.0):
+    """Start a stand-in server in a daemon thread; return it."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandinHandler)
+    server.root = os.path.abspath(root)
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.grade_jobs = GradeJobs(server.url, fail_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def make_repo(root, owner, repo, size, commits):
+    """Create a bare repo with a pull request of about size bytes total."""
+    work = tempfile.mkdtemp()
+    git = ['git', '-C', work, '-c', 'user.name=standin',
+           '-c', 'user.email=standin@example.com']
+    subprocess.check_call(git + ['init', '-q', '-b', 'master'])
+    per_commit = max(size // commits, 1)
+    for num in range(commits):
+        name = os.path.join(work, 'file_{}.py'.format(num % 20))
+        with open(name, 'wb') as f:
+            f.write(os.urandom(per_commit // 2).hex().encode('ascii'))
+        subprocess.check_call(git + ['add', '-A'])
+        subprocess.check_call(git + ['commit', '-q', '-m', str(num)])
+    git_dir = os.path.join(root, owner, repo + '.git')
+    subprocess.check_call(['git', 'clone', '-q', '--bare', work, git_dir])
+    subprocess.check_call(['git', '--git-dir', git_dir, 'update-ref',
+                           'refs/pull/1/head', 'master'])
+    shutil.rmtree(work)
+
+
+def bench(args):
+    """Compare full clones with tarball downloads against local repos."""
+    os.environ.setdefault('API_TOKEN', 'standin')
+    os.environ.setdefault('COURSE_ID', '0')
+    import auto_canvas
+
+    root = tempfile.mkdtemp()
+    try:
+        repos_root = os.path.join(root, 'repos')
+        for num in range(args.repos):
+            make_repo(repos_root, 'student{}'.format(num), 'data-structures',
+                      int(args.size * 1024 * 1024), args.commits)
+        server = start_server(repos_root)
+        auto_canvas.GITHUB_API_ROOT = server.url
+        results = []
+        for mode in auto_canvas.FETCH_MODES:
+            jobs = []
+            for num in range(args.repos):
+                path = os.path.join(root, mode, str(num))
+                os.makedirs(path)
+                url = '{}/git/student{}/data-structures/pull/1'.format(
+                    server.url, num)
+                jobs.append(auto_canvas.GitJob(
+                    {'id': num, 'url': url}, {'name': 'student{}'.format(num)},
+                    path, mode))
+            start = time.time()
+            auto_canvas.run_git_jobs(jobs, args.jobs)
+            results.append((mode, time.time() - start,
+                            sum(job.bytes for job in jobs),
+                            sum(job.failed for job in jobs)))
+        server.shutdown()
+    finally:
+        shutil.rmtree(root)
+
+    print('{:<8} {:>8} {:>10} {:>6}'.format('mode', 'seconds', 'bytes',
+                                            'failed'))
+    for mode, seconds, num_bytes, failed in results:
+        print('{:<8} {:>8.2f} {:>10} {:>6}'.format(
+            mode, seconds, auto_canvas.format_bytes(num_bytes), failed))
+
+
+def grades_bench(args):
+    """Time bulk grade uploads against the emulated progress workflow."""
+    os.environ.setdefault('API_TOKEN', 'standin')
+    os.environ.setdefault('COURSE_ID', '0')
+    import auto_canvas
+
+    server = start_server(tempfile.gettempdir(), fail_rate=args.fail_rate)
+    auto_canvas.API_ROOT = server.url + '/api/v1'
+    entries = [{'assignment_id': num % 10, 'student_id': num,
+                'grade': '{}%'.format(num % 101), 'comment': 'standin'}
+               for num in range(args.entries)]
+    for entry in random.sample(entries, args.bad):
+        entry['grade'] = 'not a grade'
+    start = time.time()
+    failed = auto_canvas.upload_grades(
+        auto_canvas.COURSE_ID, entries, args.batch_size, args.poll_interval,
+        open(os.devnull, 'w'))
+    seconds = time.time() - start
+    server.shutdown()
+
+    print('{} entries in batches of {}: {:.2f}s, {:.0f} entries/s'.format(
+        args.entries, args.batch_size, seconds, args.entries / seconds))
+    grade_jobs = server.grade_jobs
+    print('{} update_grades requests, {} applied, {} given up, {} duplicate '
+          'comments'.format(
+              len(grade_jobs.progress), len(grade_jobs.grades), len(failed),
+              sum(len(texts) - 1 for texts in grade_jobs.comments.values())))
+
+
+def main(argv=None):
+    """Serve local repos or run one of the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help='serve repos under ROOT')
+    serve.add_argument('root')
+    serve.add_argument('--port', type=int, default=8000)
+    bench_parser = commands.add_parser(
+        'bench', help='benchmark clone against tarball fetch mode')
+    bench_parser.add_argument('--repos', type=int, default=20)
+    bench_parser.add_argument('--size', type=float, default=2,
+                              help='approximate repo size in MB')
+    bench_parser.add_argument('--commits', type=int, default=60)
+    bench_parser.add_argument('-j', '--jobs', type=int, default=8)
+    grades_parser = commands.add_parser(
+        'grades', help='benchmark bulk grade uploads')
+    grades_parser.add_argument('--entries', type=int, default=2000)
+    grades_parser.add_argument('--batch-size', type=int, default=100)
+    grades_parser.add_argument('--bad', type=int, default=0,
+                               help='number of entries with invalid grades')
+    grades_parser.add_argument('--fail-rate', type=float, default=0.0,
+                               help='chance a grade job fails at random')
+    grades_parser.add_argument('--poll-interval', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        server = start_server(args.root, args.port)
+        print('serving {} at {}'.format(server.root, server.url))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == 'bench':
+        bench(args)
+    elif args.command == 'grades':
+        grades_bench(args)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
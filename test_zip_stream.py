@@ -0,0 +1,154 @@
+"""Tests for zip_stream, the streaming zip reader behind --bulk-zip.
+
+Run with: python -m pytest test_zip_stream.py
+"""
+from __future__ import unicode_literals
+import io
+import os
+import struct
+import zipfile
+
+import pytest
+
+from zip_stream import CHUNK_SIZE, iter_zip_stream, zip64_sizes
+
+MEMBERS = [
+    ('12_alice/main.py', b'print("hello")\n'),
+    ('12_alice/empty.txt', b''),
+    ('34_bob/data.bin', bytes(range(256)) * 1000),
+    ('34_bob/random.bin', os.urandom(3 * CHUNK_SIZE + 17)),
+]
+
+
+class Unseekable(object):
+    """Write-only file, so zipfile falls back to data descriptors."""
+
+    def __init__(self):
+        """Initialize with an empty buffer."""
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        """Append data to the buffer."""
+        return self.buffer.write(data)
+
+    def flush(self):
+        """Do nothing; the buffer is in memory."""
+
+
+class Trickle(object):
+    """Readable stream that hands out at most a few bytes per read."""
+
+    def __init__(self, data, size=1000):
+        """Initialize with the bytes to serve and the largest read."""
+        self.stream = io.BytesIO(data)
+        self.size = size
+
+    def read(self, size):
+        """Return up to the smaller of size and the trickle size."""
+        return self.stream.read(min(size, self.size))
+
+
+def build_zip(compression, seekable=True, force_zip64=False,
+              members=MEMBERS):
+    """Return the bytes of a zip of members written by zipfile."""
+    out = io.BytesIO() if seekable else Unseekable()
+    with zipfile.ZipFile(out, 'w', compression) as archive:
+        for name, data in members:
+            with archive.open(name, 'w', force_zip64=force_zip64) as f:
+                f.write(data)
+    return (out if seekable else out.buffer).getvalue()
+
+
+def read_all(stream):
+    """Return [(name, data)] for every member read from stream."""
+    return [(name, b''.join(chunks))
+            for name, chunks in iter_zip_stream(stream)]
+
+
+@pytest.mark.parametrize('compression, seekable, force_zip64', [
+    (zipfile.ZIP_STORED, True, False),
+    (zipfile.ZIP_DEFLATED, True, False),
+    (zipfile.ZIP_STORED, True, True),
+    (zipfile.ZIP_DEFLATED, True, True),
+    (zipfile.ZIP_DEFLATED, False, False),
+    (zipfile.ZIP_DEFLATED, False, True),
+], ids=['stored', 'deflated', 'stored-zip64', 'deflated-zip64',
+        'descriptor', 'descriptor-zip64'])
+def test_members_round_trip(compression, seekable, force_zip64):
+    data = build_zip(compression, seekable, force_zip64)
+    assert read_all(io.BytesIO(data)) == MEMBERS
+    assert read_all(Trickle(data)) == MEMBERS
+
+
+@pytest.mark.parametrize('seekable', [True, False])
+def test_unread_members_are_skipped(seekable):
+    data = build_zip(zipfile.ZIP_DEFLATED, seekable)
+    names = [name for name, chunks in iter_zip_stream(Trickle(data))]
+    assert names == [name for name, _ in MEMBERS]
+
+
+def test_descriptor_without_signature():
+    data = build_zip(zipfile.ZIP_DEFLATED, seekable=False,
+                     members=MEMBERS[:1])
+    # The descriptor signature is optional; drop the one zipfile wrote.
+    start = data.index(b'PK\x07\x08')
+    data = data[:start] + data[start + 4:]
+    assert read_all(io.BytesIO(data)) == MEMBERS[:1]
+
+
+def test_stored_member_with_descriptor_is_rejected():
+    data = build_zip(zipfile.ZIP_STORED, seekable=False)
+    with pytest.raises(zipfile.BadZipFile, match='without sizes'):
+        read_all(io.BytesIO(data))
+
+
+def test_unsupported_compression_is_rejected():
+    data = build_zip(zipfile.ZIP_BZIP2, members=MEMBERS[:1])
+    with pytest.raises(zipfile.BadZipFile, match='unsupported compression'):
+        read_all(io.BytesIO(data))
+
+
+@pytest.mark.parametrize('compression, seekable', [
+    (zipfile.ZIP_STORED, True),
+    (zipfile.ZIP_DEFLATED, True),
+    (zipfile.ZIP_DEFLATED, False),
+], ids=['stored', 'deflated', 'descriptor'])
+def test_truncated_member(compression, seekable):
+    data = build_zip(compression, seekable)
+    cut = data.index(b'34_bob/random.bin') + CHUNK_SIZE
+    with pytest.raises(zipfile.BadZipFile, match='random.bin: truncated'):
+        read_all(io.BytesIO(data[:cut]))
+
+
+def test_crc_mismatch():
+    data = bytearray(build_zip(zipfile.ZIP_STORED))
+    data[data.index(b'hello')] ^= 0xFF
+    with pytest.raises(zipfile.BadZipFile, match='main.py: CRC mismatch'):
+        read_all(io.BytesIO(bytes(data)))
+
+
+def test_crc_mismatch_in_descriptor():
+    data = bytearray(build_zip(zipfile.ZIP_DEFLATED, seekable=False,
+                               members=MEMBERS[:1]))
+    crc = data.index(b'PK\x07\x08') + 4
+    data[crc] ^= 0xFF
+    with pytest.raises(zipfile.BadZipFile, match='main.py: CRC mismatch'):
+        read_all(io.BytesIO(bytes(data)))
+
+
+def test_zip64_sizes():
+    extra = struct.pack('<HHQQ', 1, 16, 5 << 32, 3 << 32)
+    assert zip64_sizes(extra, 0xFFFFFFFF, 0xFFFFFFFF) == \
+        (3 << 32, 5 << 32, True)
+
+
+def test_zip64_sizes_only_replace_overflowed_fields():
+    extra = struct.pack('<HHQ', 1, 8, 5 << 32)
+    assert zip64_sizes(extra, 1234, 0xFFFFFFFF) == (1234, 5 << 32, True)
+
+
+def test_zip64_sizes_skip_other_fields():
+    other = struct.pack('<HH', 0x5455, 5) + b'\x01abcd'
+    extra = other + struct.pack('<HHQQ', 1, 16, 7, 6)
+    assert zip64_sizes(extra, 0xFFFFFFFF, 0xFFFFFFFF) == (6, 7, True)
+    assert zip64_sizes(other, 10, 20) == (10, 20, False)
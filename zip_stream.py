@@ -0,0 +1,146 @@
+"""Read zip archives front to back from a stream.
+
+Members are found by their local headers instead of the central
+directory at the end, so an archive can be unpacked while it downloads,
+without being seekable or held in memory. Stored and deflated members
+are supported, with sizes in the local header, in a zip64 extra field
+or in a data descriptor after the member, and every member's CRC is
+checked.
+
+Usage:
+    python zip_stream.py [ARCHIVE]  list members of ARCHIVE or stdin
+"""
+
+from __future__ import unicode_literals
+import sys
+import zlib
+import struct
+import zipfile
+import argparse
+
+CHUNK_SIZE = 64 * 1024
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+
+
+class PushbackReader(object):
+    """Exact reads from a stream, with unread data put back in front."""
+
+    def __init__(self, stream):
+        """Initialize with a file-like object to read from."""
+        self.stream = stream
+        self.buffer = b''
+        self.bytes = 0
+
+    def read(self, size):
+        """Return up to size bytes, fewer only at end of stream."""
+        while len(self.buffer) < size:
+            chunk = self.stream.read(max(size - len(self.buffer),
+                                         CHUNK_SIZE))
+            if not chunk:
+                break
+            self.bytes += len(chunk)
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def unread(self, data):
+        """Put data back to be read again first."""
+        self.buffer = data + self.buffer
+
+
+def zip64_sizes(extra, csize, usize):
+    """Return sizes and whether a member has a zip64 extra field."""
+    while len(extra) >= 4:
+        tag, length = struct.unpack('<HH', extra[:4])
+        if tag == 1:
+            values = list(struct.unpack(
+                '<{}Q'.format(length // 8), extra[4:4 + length // 8 * 8]))
+            if usize == 0xFFFFFFFF and values:
+                usize = values.pop(0)
+            if csize == 0xFFFFFFFF and values:
+                csize = values.pop(0)
+            return csize, usize, True
+        extra = extra[4 + length:]
+    return csize, usize, False
+
+
+def iter_zip_stream(stream):
+    """Yield (name, chunks) for each member of a zip read front to back.
+
+    Members are found by their local headers, so the archive never has to
+    be seekable or held in memory. Chunks a caller leaves unread are
+    skipped when the next member is asked for. Stored and deflated
+    members are supported, and each member's CRC is checked.
+    """
+    reader = PushbackReader(stream)
+    while True:
+        header = reader.read(LOCAL_HEADER.size)
+        if len(header) < 4 or header[:4] != b'PK\x03\x04':
+            # The central directory follows the last member.
+            return
+        (_, _, flags, method, _, _, crc, csize, usize, name_len,
+         extra_len) = LOCAL_HEADER.unpack(header)
+        name = reader.read(name_len).decode(
+            'utf-8' if flags & 0x800 else 'cp437')
+        csize, usize, zip64 = zip64_sizes(reader.read(extra_len), csize,
+                                          usize)
+        described = flags & 0x08
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise zipfile.BadZipFile(
+                '{}: unsupported compression {}'.format(name, method))
+        if described and method == zipfile.ZIP_STORED:
+            raise zipfile.BadZipFile(
+                '{}: stored member without sizes'.format(name))
+        found = {'crc': 0}
+
+        def chunks():
+            inflate = zlib.decompressobj(-zlib.MAX_WBITS) \
+                if method == zipfile.ZIP_DEFLATED else None
+            left = None if described else csize
+            while left is None or left > 0:
+                size = CHUNK_SIZE if left is None \
+                    else min(left, CHUNK_SIZE)
+                data = reader.read(size)
+                if not data:
+                    raise zipfile.BadZipFile('{}: truncated'.format(name))
+                if left is not None:
+                    left -= len(data)
+                if inflate is not None:
+                    data = inflate.decompress(data)
+                    if inflate.eof:
+                        reader.unread(inflate.unused_data)
+                        left = 0
+                found['crc'] = zlib.crc32(data, found['crc'])
+                if data:
+                    yield data
+
+        body = chunks()
+        yield name, body
+        for _ in body:
+            pass
+        if described:
+            signature = reader.read(4)
+            if signature != b'PK\x07\x08':
+                reader.unread(signature)
+            crc = struct.unpack('<I', reader.read(4))[0]
+            reader.read(16 if zip64 else 8)
+        if found['crc'] != crc:
+            raise zipfile.BadZipFile('{}: CRC mismatch'.format(name))
+
+
+def main(argv=None):
+    """List the members of a zip read from a file or stdin."""
+    parser = argparse.ArgumentParser(
+        description='List the members of a zip read front to back.')
+    parser.add_argument('archive', nargs='?',
+                        help='zip file to read (default: stdin)')
+    args = parser.parse_args(argv)
+    with open(args.archive, 'rb') if args.archive else \
+            open(sys.stdin.fileno(), 'rb', closefd=False) as stream:
+        for name, chunks in iter_zip_stream(stream):
+            print('{:>12} {}'.format(sum(len(data) for data in chunks),
+                                     name))
+
+
+if __name__ == '__main__':
+    main()